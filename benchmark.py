@@ -0,0 +1,385 @@
+"""
+benchmark for the frame time hot paths of cave_system.py
+
+every scenario runs headless in its own python process (so that
+class attributes and pygame state can not leak between scenarios)
+and reports frames per second, p50/p95/p99 frame time in milliseconds
+and the peak memory of its process.
+
+usage:
+    python benchmark.py                     # all scenarios -> benchmark_results.json
+    python benchmark.py -o before.json      # compare two revisions by output file
+    python benchmark.py --scenario firing   # only one scenario
+    python benchmark.py --replay session.cave  # adds a recorded session
+                                            # (cave_system.py --record)
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+SEED = 1
+WIDTH, HEIGHT = 1430, 800
+
+
+def make_viewer(governor=False):
+    """headless Viewer with seeded random numbers. Without the load
+       governor, so that every revision draws the same effects"""
+    import cave_system
+    cave_system.Game.load_governor = governor
+    random.seed(SEED)
+    viewer = cave_system.Viewer(WIDTH, HEIGHT, headless=True)
+    viewer.particles.rng = np.random.default_rng(SEED)
+    return viewer
+
+
+def scenario_firing(frames):
+    """2 players firing continuously with Game.rockets = 20"""
+    from cave_system import Game
+    Game.rockets = 20
+    viewer = make_viewer()
+
+    def script(viewer, frame):
+        viewer.player1.fire(viewer.cannon1.angle)
+        viewer.player2.fire(viewer.cannon2.angle)
+    viewer.script = script
+    viewer.run(frames=frames)
+    return viewer.frametimes
+
+
+def scenario_explosion(frames, governor=False):
+    """a mass explosion of 500 sparks (like Player.kill) every second"""
+    import pygame
+    from cave_system import Explosion, Viewer
+    viewer = make_viewer(governor)
+    center = pygame.math.Vector2(WIDTH // 2, -HEIGHT // 2)
+
+    def script(viewer, frame):
+        if frame % viewer.fps == 1:
+            Explosion(pos=center, red=255, green=255, minsparks=0,
+                      maxsparks=500, max_age=3)
+    viewer.script = script
+    viewer.run(frames=frames)
+    if governor:
+        return viewer.frametimes, {"quality": Viewer.governor.quality,
+                                   "throttled": Viewer.governor.throttled}
+    return viewer.frametimes
+
+
+def scenario_world(frames):
+    """2 players firing while flying through a world of 4 x 4 windows"""
+    import pygame
+    from cave_system import Game
+    Game.rockets = 20
+    Game.world_screens = (4, 4)
+    viewer = make_viewer()
+
+    def script(viewer, frame):
+        for player, cannon in ((viewer.player1, viewer.cannon1),
+                               (viewer.player2, viewer.cannon2)):
+            player.move = pygame.math.Vector2(300, -150)
+            player.fire(cannon.angle)
+    viewer.script = script
+    viewer.run(frames=frames)
+    return viewer.frametimes
+
+
+def scenario_turrets(frames):
+    """2 players firing into a 4 x 4 windows world with 400 turrets
+       (without turret fire, Game.peace)"""
+    import pygame
+    from cave_system import Game, Turret, Viewer
+    Game.rockets = 20
+    Game.world_screens = (4, 4)
+    viewer = make_viewer()
+    Game.peace = True
+    rng = random.Random(SEED)
+    for _ in range(400):
+        Turret(pos=pygame.math.Vector2(rng.randint(0, Viewer.world_width),
+                                       -rng.randint(0, Viewer.world_height)))
+
+    def script(viewer, frame):
+        Game.peace = True # a dying player makes peace too
+        for player, cannon in ((viewer.player1, viewer.cannon1),
+                               (viewer.player2, viewer.cannon2)):
+            player.move = pygame.math.Vector2(300, -150)
+            player.fire(cannon.angle)
+    viewer.script = script
+    viewer.run(frames=frames)
+    return viewer.frametimes
+
+
+def scenario_level(frames, tilesize):
+    """generate_level + paint_level (+ painting the terrain) at one tile size"""
+    from cave_system import Game, Viewer
+    viewer = make_viewer()
+    Game.tilesize = tilesize
+    Game.level_cache = None # measure generating, not loading
+    frametimes = []
+    for i in range(max(3, frames // 10)):
+        viewer.seeds[viewer.active_level] = SEED + i
+        start = time.perf_counter()
+        viewer.generate_level()
+        if Game.terrain_layer:
+            viewer.terrain.draw(viewer.screen, Viewer.camera)
+        frametimes.append((time.perf_counter() - start) * 1000)
+    return frametimes
+
+
+def scenario_menu(frames):
+    """menurun rendering, including the flying help text"""
+    viewer = make_viewer()
+    viewer.show_helptext()
+    frametimes = []
+    for frame in range(frames):
+        start = time.perf_counter()
+        viewer.draw_menu(frame % 5, 1 / viewer.fps)
+        frametimes.append((time.perf_counter() - start) * 1000)
+    return frametimes
+
+
+def legacy_default_parameters(self, **kwargs):
+    """VectorSprite._default_parameters before __slots__ and class level
+       defaults (frozen copy for the sprites scenario): every default
+       is set on every instance"""
+    import pygame
+    from cave_system import Viewer
+    for key, arg in kwargs.items():
+        setattr(self, key, arg)
+    if "layer" not in kwargs:
+        self._layer = 4
+    else:
+        self._layer = self.layer
+    if "static" not in kwargs:
+        self.static = False
+    if "pos" not in kwargs:
+        self.pos = pygame.math.Vector2(random.randint(0, Viewer.world_width),-50)
+    if "move" not in kwargs:
+        self.move = pygame.math.Vector2(0,0)
+    if "radius" not in kwargs:
+        self.radius = 5
+    if "width" not in kwargs:
+        self.width = self.radius * 2
+    if "height" not in kwargs:
+        self.height = self.radius * 2
+    if "color" not in kwargs:
+        self.color = (random.randint(0,255), random.randint(0,255), random.randint(0,255))
+    if "hitpoints" not in kwargs:
+        self.hitpoints = 100
+    self.hitpointsfull = self.hitpoints
+    if "mass" not in kwargs:
+        self.mass = 10
+    if "damage" not in kwargs:
+        self.damage = 10
+    if "bounce_on_edge" not in kwargs:
+        self.bounce_on_edge = False
+    if "kill_on_edge" not in kwargs:
+        self.kill_on_edge = False
+    if "angle" not in kwargs:
+        self.angle = 0
+    if "max_age" not in kwargs:
+        self.max_age = None
+    if "max_distance" not in kwargs:
+        self.max_distance = None
+    if "picture" not in kwargs:
+        self.picture = None
+    if "bossnumber" not in kwargs:
+        self.bossnumber = None
+    if "kill_with_boss" not in kwargs:
+        self.kill_with_boss = False
+    if "sticky_with_boss" not in kwargs:
+        self.sticky_with_boss = False
+    if "mass" not in kwargs:
+        self.mass = 15
+    if "upkey" not in kwargs:
+        self.upkey = None
+    if "downkey" not in kwargs:
+        self.downkey = None
+    if "rightkey" not in kwargs:
+        self.rightkey = None
+    if "leftkey" not in kwargs:
+        self.leftkey = None
+    if "speed" not in kwargs:
+        self.speed = None
+    if "age" not in kwargs:
+        self.age = 0
+    if "warp_on_edge" not in kwargs:
+        self.warp_on_edge = False
+    if "msg" not in kwargs:
+        self.msg = ""
+
+
+def scenario_sprites(frames):
+    """micro benchmark: constructing VectorSprite and Tile, next to
+       legacy subclasses with the old _default_parameters. Reports
+       milliseconds per 1000 sprites and the python memory per sprite
+       (tracemalloc, without SDL pixel data) instead of frame times.
+       The legacy classes still inherit __slots__, so their memory is
+       a lower bound of the old classes"""
+    import tracemalloc
+    import pygame
+    from cave_system import VectorSprite, Tile
+    make_viewer()
+    legacy = {"_default_parameters": legacy_default_parameters}
+    LegacyVectorSprite = type("LegacyVectorSprite", (VectorSprite,), legacy)
+    LegacyTile = type("LegacyTile", (Tile,), legacy)
+    classes = {}
+    for prefix, vectorsprite, tile in (("", VectorSprite, Tile),
+                                       ("legacy_", LegacyVectorSprite, LegacyTile)):
+        classes[prefix + "vectorsprite"] = (
+            lambda i, cls=vectorsprite: cls(pos=pygame.math.Vector2(i, -i)))
+        classes[prefix + "tile"] = (
+            lambda i, cls=tile: cls(pos=pygame.math.Vector2(i, -i), tile_status=0,
+                                    gridx=i, gridy=0))
+    extra = {}
+    for name, make in classes.items():
+        times = []
+        for _ in range(max(3, frames // 20)):
+            start = time.perf_counter()
+            sprites = [make(i) for i in range(1000)]
+            times.append((time.perf_counter() - start) * 1000)
+            for sprite in sprites:
+                sprite.kill()
+        extra[name + "_ms_per_1000"] = round(float(np.median(times)), 3)
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        sprites = [make(i) for i in range(1000)]
+        extra[name + "_bytes_per_sprite"] = (tracemalloc.get_traced_memory()[0] - before) // 1000
+        tracemalloc.stop()
+        for sprite in sprites:
+            sprite.kill()
+    return None, extra
+
+
+def scenario_replay(frames, filename):
+    """a session recorded with cave_system.py --record, replayed as
+       fast as possible. Plays all recorded frames, ignores frames"""
+    from cave_system import SessionLog, Viewer
+    replay = SessionLog.open(filename)
+    viewer = Viewer(replay.width, replay.height, fps=replay.fps, headless=True)
+    viewer.replay = replay
+    viewer.run()
+    return viewer.frametimes
+
+
+def scenarios():
+    """{name: function(frames)}"""
+    from cave_system import Game
+    result = {"firing": scenario_firing,
+              "explosion": scenario_explosion,
+              "explosion_governed": lambda frames: scenario_explosion(frames, governor=True),
+              "world": scenario_world,
+              "turrets": scenario_turrets,
+              "menu": scenario_menu,
+              "sprites": scenario_sprites}
+    for text in Game.tilesizemenu:
+        if text.isdigit():
+            result["level_tilesize_" + text] = (
+                lambda frames, tilesize=int(text): scenario_level(frames, tilesize))
+    return result
+
+
+def peak_memory_kb():
+    """peak resident memory of this process in kilobytes, or None"""
+    try:
+        import resource
+    except ImportError: # windows
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin": # bytes on mac, kilobytes on linux
+        peak //= 1024
+    return peak
+
+
+def summary(frametimes):
+    times = np.array(frametimes)
+    return {"frames": len(times),
+            "fps": round(len(times) / (times.sum() / 1000), 1),
+            "p50_ms": round(float(np.percentile(times, 50)), 3),
+            "p95_ms": round(float(np.percentile(times, 95)), 3),
+            "p99_ms": round(float(np.percentile(times, 99)), 3),
+            "peak_memory_kb": peak_memory_kb()}
+
+
+def run_child(name, frames):
+    """runs one scenario in this process and prints its summary as json.
+       A scenario returns its frame times, or frame times and a dict
+       of extra results. Without frame times (None) only the extra
+       results and the peak memory are reported"""
+    if name.startswith("replay:"):
+        result = scenario_replay(frames, name[len("replay:"):])
+    else:
+        result = scenarios()[name](frames)
+    extra = {}
+    if isinstance(result, tuple):
+        result, extra = result
+    if result is None:
+        report = {"peak_memory_kb": peak_memory_kb()}
+    else:
+        report = summary(result)
+    report.update(extra)
+    print("RESULT " + json.dumps(report))
+
+
+def run_all(names, frames):
+    results = {}
+    for name in names:
+        print("running", name, "...", flush=True)
+        output = subprocess.run([sys.executable, os.path.abspath(__file__),
+                                 "--child", name, "--frames", str(frames)],
+                                capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)))
+        lines = [l for l in output.stdout.splitlines() if l.startswith("RESULT ")]
+        if output.returncode != 0 or not lines:
+            print(output.stderr)
+            results[name] = {"error": output.returncode}
+            continue
+        results[name] = json.loads(lines[-1][len("RESULT "):])
+        print("   ", results[name])
+    return results
+
+
+def revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"],
+                              capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))
+                              ).stdout.strip() or None
+    except OSError:
+        return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="cave system benchmark")
+    parser.add_argument("-o", "--output", default="benchmark_results.json",
+                        help="json file for the results")
+    parser.add_argument("--frames", type=int, default=300,
+                        help="frames per scenario")
+    parser.add_argument("--scenario", action="append",
+                        help="run only this scenario (can be repeated)")
+    parser.add_argument("--replay", action="append",
+                        help="also replay this recorded session (can be repeated)")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    replays = ["replay:" + os.path.abspath(f) for f in args.replay or []]
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    os.chdir(os.path.dirname(os.path.abspath(__file__))) # for data folder
+    if args.child:
+        run_child(args.child, args.frames)
+        sys.exit()
+    names = (args.scenario or ([] if replays else list(scenarios()))) + replays
+    report = {"revision": revision(),
+              "python": platform.python_version(),
+              "platform": platform.platform(),
+              "frames": args.frames,
+              "scenarios": run_all(names, args.frames)}
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print("results written to", args.output)
@@ -7,26 +7,43 @@ download: https://github.com/PaulPolaschek/Cave_system
 
 
 import pygame
+import numpy as np
 import random
+import functools
+import collections
+import argparse
+import json
 import os
-#import time
+import time
 import math
+import struct
+import concurrent.futures
+
+@functools.lru_cache(maxsize=None)
+def get_font(name=None, size=42, bold=False):
+    """returns pygame font. SysFont searches the system fonts,
+       so each (name, size, bold) is only looked up once"""
+    return pygame.font.SysFont(name, size, bold=bold)
+
+@functools.lru_cache(maxsize=1024)
+def render_text(text, color, fontsize, font=None, bold=False):
+    """returns rendered text surface, cached by (text, color, size, ...).
+       The surface is shared: never draw on it. Hits and misses
+       are counted by render_text.cache_info()"""
+    mytext = get_font(font, fontsize, bold).render(text, True, color)
+    return mytext.convert_alpha()
 
 def make_text(msg="pygame is cool", fontcolor=(255, 0, 255), fontsize=42, font=None):
     """returns pygame surface with text. You still need to blit the surface."""
-    myfont = pygame.font.SysFont(font, fontsize)
-    mytext = myfont.render(msg, True, fontcolor)
-    mytext = mytext.convert_alpha()
-    return mytext
+    return render_text(msg, tuple(fontcolor), fontsize, font)
 
 def write(background, text, x=50, y=150, color=(0,0,0),
           fontsize=None, center=False):
         """write text on pygame surface. """
         if fontsize is None:
             fontsize = 24
-        font = pygame.font.SysFont('mono', fontsize, bold=True)
-        fw, fh = font.size(text)
-        surface = font.render(text, True, color)
+        surface = render_text(text, tuple(color), fontsize, "mono", True)
+        fw, fh = surface.get_size()
         if center: # center text around x,y
             background.blit(surface, (x-fw//2, y-fh//2))
         else:      # topleft corner is x,y
@@ -65,7 +82,29 @@ def elastic_collision(sprite1, sprite2):
                 sprite1.move.x -= 2 * dirx * cdp
                 sprite1.move.y -= 2 * diry * cdp
 
+class Frames():
+    """pre-rendered animation frames, shared by all sprites of one kind.
+       render(state) paints the image for one visual state. Each state
+       is rendered only once, after that a sprite just switches frames."""
+
+    def __init__(self, render):
+        self.render = render
+        self.images = {} # {state: image}
+
+    def __getitem__(self, state):
+        image = self.images.get(state)
+        if image is None:
+            image = self.images[state] = self.render(state)
+        return image
+
+    def prerender(self, states):
+        for state in states:
+            self[state]
+
+
 class Flytext(pygame.sprite.Sprite):
+    screen_space = True # drawn at rect, not moved by the Camera
+
     def __init__(self, x, y, text="hallo", color=(255, 0, 0),
                  dx=0, dy=-50, duration=2, acceleration_factor = 1.0, delay = 0, fontsize=22, left_align=False):
         """a text flying upward and for a short time and disappearing"""
@@ -101,6 +140,8 @@ class Flytext(pygame.sprite.Sprite):
                 self.kill()      # remove Sprite from screen and from groups
 
 class Mouse(pygame.sprite.Sprite):
+    screen_space = True
+
     def __init__(self, radius = 50, color=(255,0,0), x=320, y=240,
                     startx=100,starty=100, control="mouse", ):
         """create a (black) surface and paint a blue Mouse on it"""
@@ -127,44 +168,52 @@ class Mouse(pygame.sprite.Sprite):
         self.control = control # "mouse" "keyboard1" "keyboard2"
         self.pushed = False
 
+    tail_length = 128 # points of the mouse tail, at full quality
+    frames = Frames(lambda state: Mouse.render_frame(*state))
+
     def create_image(self):
+        self.image = Mouse.frames[(self.radius, self.r, self.g, self.b)]
+        self.rect=self.image.get_rect()
+        self.rect.center = self.x, self.y
 
-        self.image = pygame.surface.Surface((self.radius*0.5, self.radius*0.5))
+    @staticmethod
+    def render_frame(radius, r, g, b):
+        """paints the crosshair in red shade r, see Mouse.frames"""
+        image = pygame.surface.Surface((radius*0.5, radius*0.5))
         delta1 = 12.5
         delta2 = 25
-        w = self.radius*0.5 / 100.0
-        h = self.radius*0.5 / 100.0
+        w = radius*0.5 / 100.0
+        h = radius*0.5 / 100.0
         # pointing down / up
         for y in (0,2,4):
-            pygame.draw.line(self.image,(self.r-delta2,self.g,self.b),
+            pygame.draw.line(image,(r-delta2,g,b),
                          (35*w,0+y),(50*w,15*h+y),2)
-            pygame.draw.line(self.image,(self.r-delta2,self.g,self.b),
+            pygame.draw.line(image,(r-delta2,g,b),
                          (50*w,15*h+y),(65*w,0+y),2)
     
-            pygame.draw.line(self.image,(self.r-delta2,self.g,self.b),
+            pygame.draw.line(image,(r-delta2,g,b),
                          (35*w,100*h-y),(50*w,85*h-y),2)
-            pygame.draw.line(self.image,(self.r-delta2,self.g,self.b),
+            pygame.draw.line(image,(r-delta2,g,b),
                          (50*w,85*h-y),(65*w,100*h-y),2)
         # pointing right / left                 
         for x in (0,2,4):
-            pygame.draw.line(self.image,(self.r-delta2,self.g,self.b),
+            pygame.draw.line(image,(r-delta2,g,b),
                          (0+x,35*h),(15*w+x,50*h),2)
-            pygame.draw.line(self.image,(self.r-delta2,self.g,self.b),
+            pygame.draw.line(image,(r-delta2,g,b),
                          (15*w+x,50*h),(0+x,65*h),2)
             
-            pygame.draw.line(self.image,(self.r-delta2,self.g,self.b),
+            pygame.draw.line(image,(r-delta2,g,b),
                          (100*w-x,35*h),(85*w-x,50*h),2)
-            pygame.draw.line(self.image,(self.r-delta2,self.g,self.b),
+            pygame.draw.line(image,(r-delta2,g,b),
                          (85*w-x,50*h),(100*w-x,65*h),2)
-        self.image.set_colorkey((0,0,0))
-        self.rect=self.image.get_rect()
-        self.rect.center = self.x, self.y
+        image.set_colorkey((0,0,0))
+        return image
 
     def update(self, seconds):
         if self.control == "mouse":
-            self.x, self.y = pygame.mouse.get_pos()
+            self.x, self.y = Viewer.input.mouse
         elif self.control == "keyboard1":
-            pressed = pygame.key.get_pressed()
+            pressed = Viewer.input.keys
             if pressed[pygame.K_LSHIFT]:
                 delta = 2
             else:
@@ -178,7 +227,7 @@ class Mouse(pygame.sprite.Sprite):
             if pressed[pygame.K_d]:
                 self.x += delta
         elif self.control == "keyboard2":
-            pressed = pygame.key.get_pressed()
+            pressed = Viewer.input.keys
             if pressed[pygame.K_RSHIFT]:
                 delta = 2
             else:
@@ -204,7 +253,7 @@ class Mouse(pygame.sprite.Sprite):
         elif self.y > Viewer.height:
             self.y = Viewer.height
         self.tail.insert(0,(self.x,self.y))
-        self.tail = self.tail[:128]
+        self.tail = self.tail[:Mouse.tail_length] # Viewer.run draws a scaled part
         self.rect.center = self.x, self.y
         self.r += self.delta   # self.r can take the values from 255 to 101
         if self.r < 151:
@@ -215,10 +264,202 @@ class Mouse(pygame.sprite.Sprite):
             self.delta = -10
         self.create_image()
 
+class RotationCache():
+    """pre-rotated images shared by all sprites, keyed by
+       (source image, angle rounded to step degrees).
+       The least recently used images are dropped when all
+       rotated images together need more than maxbytes."""
+
+    def __init__(self, maxbytes=32*1024*1024, step=1):
+        self.maxbytes = maxbytes
+        self.step = step
+        self.images = collections.OrderedDict() # {(id(image0), angle): (image0, rotated)}
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def rotate(self, image0, angle):
+        """returns image0 rotated by angle degrees"""
+        angle = round(angle / self.step) * self.step % 360
+        key = (id(image0), angle)
+        entry = self.images.get(key)
+        if entry is not None:
+            self.hits += 1
+            self.images.move_to_end(key)
+            return entry[1]
+        self.misses += 1
+        rotated = pygame.transform.rotate(image0, angle)
+        # image0 stays referenced, so its id can not be reused while cached
+        self.images[key] = (image0, rotated)
+        self.bytes += rotated.get_width() * rotated.get_height() * rotated.get_bytesize()
+        while self.bytes > self.maxbytes and len(self.images) > 1:
+            image0, old = self.images.popitem(last=False)[1]
+            self.bytes -= old.get_width() * old.get_height() * old.get_bytesize()
+        return rotated
+
+    def prewarm(self, image0):
+        """rotates image0 into every angle step in advance"""
+        for angle in range(0, 360, self.step):
+            self.rotate(image0, angle)
+
+
+class Pool():
+    """recycles killed sprites of one VectorSprite class, so that short
+       lived sprites (rockets, flames, sparks) are not built from scratch
+       for every shot. Counts how many sprites were created and reused."""
+
+    def __init__(self, cls):
+        self.cls = cls
+        self.free = [] # killed sprites waiting for reuse
+        self.created = 0
+        self.reused = 0
+
+    def get(self, **kwargs):
+        if self.free:
+            sprite = self.free.pop()
+            sprite.reset(**kwargs)
+            self.reused += 1
+        else:
+            sprite = self.cls(**kwargs)
+            self.created += 1
+        return sprite
+
+    def put(self, sprite):
+        self.free.append(sprite)
+
+    def reuse_rate(self):
+        total = self.created + self.reused
+        return self.reused / total if total else 0.0
+
+    def __str__(self):
+        return "{}: {} free, {} created, {} reused ({:.0%})".format(
+            self.cls.__name__, len(self.free), self.created, self.reused,
+            self.reuse_rate())
+
+
+class EntityStore():
+    """position, movement, age, max_age, distance_traveled and hitpoints
+       of many sprites (see StoredSprite) in numpy arrays, one row per
+       sprite (its slot). update moves, ages and expires all of them
+       at once instead of one sprite after the other."""
+
+    # edge handling per slot, from kill_on_edge / bounce_on_edge / warp_on_edge
+    NOTHING, KILL, BOUNCE, WARP = 0, 1, 2, 3
+
+    def __init__(self, capacity=64):
+        self.pos = np.zeros((capacity, 2))  # world coordinates (y negative)
+        self.move = np.zeros((capacity, 2))
+        self.age = np.zeros(capacity)
+        self.max_age = np.full(capacity, np.inf)  # inf for None
+        self.distance = np.zeros(capacity)
+        self.max_distance = np.full(capacity, np.inf)
+        self.hitpoints = np.zeros(capacity)
+        self.edge = np.zeros(capacity, dtype=np.int8)
+        self.active = np.zeros(capacity, dtype=bool)  # slot belongs to a living sprite
+        self.seconds = np.zeros(capacity)  # how far each slot moved in the last update
+        self.sprites = [None] * capacity
+        self.used = 0  # next free slot, slots are never freed (sprites are pooled)
+
+    def add(self, sprite):
+        """returns a new slot for sprite, the arrays grow if necessary"""
+        if self.used == len(self.sprites):
+            n = len(self.sprites)
+            self.pos = np.concatenate((self.pos, np.zeros((n, 2))))
+            self.move = np.concatenate((self.move, np.zeros((n, 2))))
+            self.age = np.concatenate((self.age, np.zeros(n)))
+            self.max_age = np.concatenate((self.max_age, np.full(n, np.inf)))
+            self.distance = np.concatenate((self.distance, np.zeros(n)))
+            self.max_distance = np.concatenate((self.max_distance, np.full(n, np.inf)))
+            self.hitpoints = np.concatenate((self.hitpoints, np.zeros(n)))
+            self.edge = np.concatenate((self.edge, np.zeros(n, dtype=np.int8)))
+            self.active = np.concatenate((self.active, np.zeros(n, dtype=bool)))
+            self.seconds = np.concatenate((self.seconds, np.zeros(n)))
+            self.sprites.extend([None] * n)
+        slot = self.used
+        self.used += 1
+        self.sprites[slot] = sprite
+        self.active[slot] = True
+        return slot
+
+    def __len__(self):
+        return int(self.active.sum())
+
+    def update(self, seconds):
+        """kills expired sprites, then moves and ages the others and
+           handles the world edges (like VectorSprite.update/wallbounce).
+           seconds is one number or one per slot (0 for frozen slots)"""
+        expired = self.active & ((self.hitpoints <= 0) | (self.age > self.max_age)
+                                 | (self.distance > self.max_distance))
+        for slot in np.nonzero(expired)[0]:
+            self.sprites[slot].kill()
+        seconds = np.broadcast_to(seconds, self.age.shape)
+        self.seconds = seconds.copy()
+        # inactive rows move too, nobody looks at them
+        self.pos += self.move * seconds[:,None]
+        self.distance += np.hypot(self.move[:,0], self.move[:,1]) * seconds
+        self.age += seconds
+        x = self.pos[:,0]
+        y = self.pos[:,1]
+        left = x < 0
+        top = y > 0
+        right = x > Viewer.world_width
+        bottom = y < -Viewer.world_height
+        outside = self.active & (left | top | right | bottom)
+        if not outside.any():
+            return
+        bounce = outside & (self.edge == EntityStore.BOUNCE)
+        warp = outside & (self.edge == EntityStore.WARP)
+        x[bounce & left] = 0
+        x[bounce & right] = Viewer.world_width
+        y[bounce & top] = 0
+        y[bounce & bottom] = -Viewer.world_height
+        self.move[bounce & (left | right), 0] *= -1
+        self.move[bounce & (top | bottom), 1] *= -1
+        x[warp & left] = Viewer.world_width
+        x[warp & right] = 0
+        y[warp & top] = -Viewer.world_height
+        y[warp & bottom] = 0
+        for slot in np.nonzero(outside & (self.edge == EntityStore.KILL))[0]:
+            self.sprites[slot].kill()
+
+
 class VectorSprite(pygame.sprite.Sprite):
-    """base class for sprites. this class inherits from pygames sprite class"""
+    """base class for sprites. this class inherits from pygames sprite class.
+       Every keyword argument becomes an attribute, missing ones fall back
+       to the class level defaults below. The fields that every sprite
+       sets for itself are __slots__ (pygames Sprite has no __slots__, so
+       a small __dict__ stays for everything else)"""
+    __slots__ = ("pos", "move", "color", "hitpoints", "hitpointsfull", "angle",
+                 "age", "distance_traveled", "width", "height",
+                 "image", "image0", "rect")
+    # ---- defaults for missing keyword arguments ----
+    _layer = 4
+    static = False
+    radius = 5
+    mass = 15
+    damage = 10
+    bounce_on_edge = False
+    kill_on_edge = False
+    warp_on_edge = False
+    max_age = None
+    max_distance = None
+    picture = None
+    bossnumber = None
+    kill_with_boss = False
+    sticky_with_boss = False
+    upkey = None
+    downkey = None
+    rightkey = None
+    leftkey = None
+    speed = None
+    msg = ""
+
     number = 0
     numbers = {} # { number, Sprite }
+    rotations = RotationCache()
+    pooled = False # killed sprites of pooled classes are recycled by spawn
+    pools = {} # {class: Pool}
+    screen_space = False # world sprites are drawn moved by the Camera
 
     def __init__(self, **kwargs):
         self._default_parameters(**kwargs)
@@ -241,77 +482,76 @@ class VectorSprite(pygame.sprite.Sprite):
         pass
 
     def _default_parameters(self, **kwargs):    
-        """get unlimited named arguments and turn them into attributes
-           default values for missing keywords"""
+        """get unlimited named arguments and turn them into attributes.
+           default values for missing keywords are class attributes,
+           only the __slots__ fields are set here"""
 
         for key, arg in kwargs.items():
             setattr(self, key, arg)
-        if "layer" not in kwargs:
-            self._layer = 4
-        else:
+        if "layer" in kwargs:
             self._layer = self.layer
-        if "static" not in kwargs:
-            self.static = False
         if "pos" not in kwargs:
-            self.pos = pygame.math.Vector2(random.randint(0, Viewer.width),-50)
+            self.pos = pygame.math.Vector2(random.randint(0, Viewer.world_width),-50)
         if "move" not in kwargs:
             self.move = pygame.math.Vector2(0,0)
-        if "radius" not in kwargs:
-            self.radius = 5
         if "width" not in kwargs:
             self.width = self.radius * 2
         if "height" not in kwargs:
             self.height = self.radius * 2
         if "color" not in kwargs:
-            #self.color = None
             self.color = (random.randint(0,255), random.randint(0,255), random.randint(0,255))
         if "hitpoints" not in kwargs:
             self.hitpoints = 100
         self.hitpointsfull = self.hitpoints # makes a copy
-        if "mass" not in kwargs:
-            self.mass = 10
-        if "damage" not in kwargs:
-            self.damage = 10
-        if "bounce_on_edge" not in kwargs:
-            self.bounce_on_edge = False
-        if "kill_on_edge" not in kwargs:
-            self.kill_on_edge = False
         if "angle" not in kwargs:
             self.angle = 0 # facing right?
-        if "max_age" not in kwargs:
-            self.max_age = None
-        if "max_distance" not in kwargs:
-            self.max_distance = None
-        if "picture" not in kwargs:
-            self.picture = None
-        if "bossnumber" not in kwargs:
-            self.bossnumber = None
-        if "kill_with_boss" not in kwargs:
-            self.kill_with_boss = False
-        if "sticky_with_boss" not in kwargs:
-            self.sticky_with_boss = False
-        if "mass" not in kwargs:
-            self.mass = 15
-        if "upkey" not in kwargs:
-            self.upkey = None
-        if "downkey" not in kwargs:
-            self.downkey = None
-        if "rightkey" not in kwargs:
-            self.rightkey = None
-        if "leftkey" not in kwargs:
-            self.leftkey = None
-        if "speed" not in kwargs:
-            self.speed = None
         if "age" not in kwargs:
             self.age = 0 # age in seconds
-        if "warp_on_edge" not in kwargs:
-            self.warp_on_edge = False
-        if "msg" not in kwargs:
-            self.msg = ""
+
+    @classmethod
+    def spawn(cls, **kwargs):
+        """like cls(**kwargs), but reuses a killed sprite if cls is pooled"""
+        if not cls.pooled:
+            return cls(**kwargs)
+        return cls.get_pool().get(**kwargs)
+
+    @classmethod
+    def get_pool(cls):
+        if cls not in VectorSprite.pools:
+            VectorSprite.pools[cls] = Pool(cls)
+        return VectorSprite.pools[cls]
+
+    def reset(self, **kwargs):
+        """brings a killed sprite back to life with new kwargs. Only the
+           fields that change between two lives are set, the other
+           attributes are still there from _default_parameters"""
+        for key, arg in kwargs.items():
+            setattr(self, key, arg)
+        self.age = 0
+        self.distance_traveled = 0
+        if "hitpoints" in kwargs:
+            self.hitpointsfull = self.hitpoints
+        else:
+            self.hitpoints = self.hitpointsfull
+        self._overwrite_parameters()
+        self.number = VectorSprite.number
+        VectorSprite.number += 1
+        VectorSprite.numbers[self.number] = self
+        self.add(self.groups)
+        self.recycle_image()
+        self.rect.center = (-300,-300)
+        if self.angle != 0:
+            self.set_angle(self.angle)
+
+    def recycle_image(self):
+        """called by reset, pooled classes can keep their old image"""
+        self.create_image()
 
     def kill(self):
         if self.number in self.numbers:
            del VectorSprite.numbers[self.number] # remove Sprite from numbers dict
+        if self.pooled and self.alive():
+            self.get_pool().put(self)
         pygame.sprite.Sprite.kill(self)
 
     def create_image(self):
@@ -330,8 +570,7 @@ class VectorSprite(pygame.sprite.Sprite):
         """rotates a sprite and changes it's angle by by_degree"""
         self.angle += by_degree
         oldcenter = self.rect.center
-        self.image = pygame.transform.rotate(self.image0, self.angle)
-        self.image.convert_alpha()
+        self.image = VectorSprite.rotations.rotate(self.image0, self.angle)
         self.rect = self.image.get_rect()
         self.rect.center = oldcenter
 
@@ -339,8 +578,7 @@ class VectorSprite(pygame.sprite.Sprite):
         """rotates a sprite and changes it's angle to degree"""
         self.angle = degree
         oldcenter = self.rect.center
-        self.image = pygame.transform.rotate(self.image0, self.angle)
-        self.image.convert_alpha()
+        self.image = VectorSprite.rotations.rotate(self.image0, self.angle)
         self.rect = self.image.get_rect()
         self.rect.center = oldcenter
 
@@ -370,7 +608,7 @@ class VectorSprite(pygame.sprite.Sprite):
         self.rect.center = ( round(self.pos.x, 0), -round(self.pos.y, 0) )
 
     def wallbounce(self):
-        # ---- bounce / kill on screen edge ----
+        # ---- bounce / kill on world edge ----
         # ------- left edge ----
         if self.pos.x < 0:
             if self.kill_on_edge:
@@ -379,7 +617,7 @@ class VectorSprite(pygame.sprite.Sprite):
                 self.pos.x = 0
                 self.move.x *= -1
             elif self.warp_on_edge:
-                self.pos.x = Viewer.width 
+                self.pos.x = Viewer.world_width 
         # -------- upper edge -----
         if self.pos.y  > 0:
             if self.kill_on_edge:
@@ -388,36 +626,145 @@ class VectorSprite(pygame.sprite.Sprite):
                 self.pos.y = 0
                 self.move.y *= -1
             elif self.warp_on_edge:
-                self.pos.y = -Viewer.height
+                self.pos.y = -Viewer.world_height
         # -------- right edge -----                
-        if self.pos.x  > Viewer.width:
+        if self.pos.x  > Viewer.world_width:
             if self.kill_on_edge:
                 self.kill()
             elif self.bounce_on_edge:
-                self.pos.x = Viewer.width
+                self.pos.x = Viewer.world_width
                 self.move.x *= -1
             elif self.warp_on_edge:
                 self.pos.x = 0
         # --------- lower edge ------------
-        if self.pos.y   < -Viewer.height:
+        if self.pos.y   < -Viewer.world_height:
             if self.kill_on_edge:
                 self.hitpoints = 0
                 self.kill()
             elif self.bounce_on_edge:
-                self.pos.y = -Viewer.height
+                self.pos.y = -Viewer.world_height
                 self.move.y *= -1
             elif self.warp_on_edge:
                 self.pos.y = 0
 
 
-class Spark(VectorSprite):
-    
+class StoredSprite(VectorSprite):
+    """a VectorSprite whose pos, move, age, max_age, distance_traveled
+       and hitpoints live in the EntityStore StoredSprite.store. The
+       attributes are views on the store: pos and move return a copy,
+       so change them by assignment (sprite.pos = ...), not in place.
+       Stored sprites are always pooled, a sprite keeps its slot forever.
+       Viewer.update_sprites calls StoredSprite.store.update once per
+       step."""
+
+    store = EntityStore()
+    pooled = True
+
+    def __init__(self, **kwargs):
+        self.slot = StoredSprite.store.add(self)
+        VectorSprite.__init__(self, **kwargs)
+        self.store_edge()
+
+    def reset(self, **kwargs):
+        StoredSprite.store.active[self.slot] = True
+        VectorSprite.reset(self, **kwargs)
+        self.store_edge()
+
+    def store_edge(self):
+        if self.kill_on_edge:
+            edge = EntityStore.KILL
+        elif self.bounce_on_edge:
+            edge = EntityStore.BOUNCE
+        elif self.warp_on_edge:
+            edge = EntityStore.WARP
+        else:
+            edge = EntityStore.NOTHING
+        StoredSprite.store.edge[self.slot] = edge
+
+    def kill(self):
+        if self.alive():
+            StoredSprite.store.active[self.slot] = False
+        VectorSprite.kill(self)
+
+    @property
+    def pos(self):
+        return pygame.math.Vector2(*StoredSprite.store.pos[self.slot])
+
+    @pos.setter
+    def pos(self, value):
+        StoredSprite.store.pos[self.slot] = value
+
+    @property
+    def move(self):
+        return pygame.math.Vector2(*StoredSprite.store.move[self.slot])
+
+    @move.setter
+    def move(self, value):
+        StoredSprite.store.move[self.slot] = value
+
+    @property
+    def age(self):
+        return float(StoredSprite.store.age[self.slot])
+
+    @age.setter
+    def age(self, value):
+        StoredSprite.store.age[self.slot] = value
+
+    @property
+    def max_age(self):
+        value = StoredSprite.store.max_age[self.slot]
+        return None if value == np.inf else float(value)
+
+    @max_age.setter
+    def max_age(self, value):
+        StoredSprite.store.max_age[self.slot] = np.inf if value is None else value
+
+    @property
+    def distance_traveled(self):
+        return float(StoredSprite.store.distance[self.slot])
+
+    @distance_traveled.setter
+    def distance_traveled(self, value):
+        StoredSprite.store.distance[self.slot] = value
+
+    @property
+    def max_distance(self):
+        value = StoredSprite.store.max_distance[self.slot]
+        return None if value == np.inf else float(value)
+
+    @max_distance.setter
+    def max_distance(self, value):
+        StoredSprite.store.max_distance[self.slot] = np.inf if value is None else value
+
+    @property
+    def hitpoints(self):
+        return float(StoredSprite.store.hitpoints[self.slot])
+
+    @hitpoints.setter
+    def hitpoints(self, value):
+        StoredSprite.store.hitpoints[self.slot] = value
+
+    def update(self, seconds):
+        """movement, aging and expiry already happened for all stored
+           sprites in EntityStore.update, this only follows the boss
+           and puts the rect on pos"""
+        if self.bossnumber is not None:
+            if self.bossnumber not in VectorSprite.numbers:
+                if self.kill_with_boss:
+                    self.kill()
+            elif self.sticky_with_boss:
+                StoredSprite.store.pos[self.slot] = VectorSprite.numbers[self.bossnumber].pos
+        x, y = StoredSprite.store.pos[self.slot].tolist()
+        self.rect.center = (round(x), -round(y))
+
+
+class Spark(StoredSprite):
+    pass
+
     def create_image(self):
         self.image = pygame.Surface((10,3))
-        print("spark created with color", self.color)
         if self.color == [0,0,0]:
             self.color = (random.randint(0,255),random.randint(0,255),random.randint(0,255))
-        print("self color changed to", self.color)
         pygame.draw.line(self.image, self.color, (1,1),(random.randint(5,10),1), random.randint(1,3))
         self.image.set_colorkey((0,0,0))
         self.image.convert_alpha()
@@ -426,11 +773,86 @@ class Spark(VectorSprite):
         self.image0 = self.image.copy()
     
 
+class Particles():
+    """all sparks of all explosions, kept in contiguous numpy arrays.
+       Moved, aged and drawn as a whole each frame instead of one
+       Spark sprite per spark. Positions are world coordinates with y
+       pointing down (like rect coordinates), draw subtracts the camera."""
+
+    def __init__(self, seed=None):
+        self.rng = np.random.default_rng(seed)
+        self.pos = np.zeros((0,2), dtype=np.float32)
+        self.move = np.zeros((0,2), dtype=np.float32)
+        self.age = np.zeros(0, dtype=np.float32)
+        self.max_age = np.zeros(0, dtype=np.float32)
+        self.color = np.zeros((0,3), dtype=np.uint8)
+        self.length = np.zeros(0, dtype=np.int8)
+
+    def __len__(self):
+        return len(self.age)
+
+    def spawn(self, pos, move, max_age, color, length):
+        """adds sparks. pos, move: (n,2) arrays, color: (n,3) array"""
+        n = len(move)
+        self.pos = np.concatenate((self.pos, pos))
+        self.move = np.concatenate((self.move, move))
+        self.age = np.concatenate((self.age, np.zeros(n, dtype=np.float32)))
+        self.max_age = np.concatenate((self.max_age, np.full(n, max_age, dtype=np.float32)))
+        self.color = np.concatenate((self.color, color))
+        self.length = np.concatenate((self.length, length))
+
+    def update(self, seconds):
+        self.pos += self.move * seconds
+        self.age += seconds
+        x = self.pos[:,0]
+        y = self.pos[:,1]
+        alive = ((self.age <= self.max_age) & (x >= 0) & (x < Viewer.world_width)
+                 & (y >= 0) & (y < Viewer.world_height))
+        if not alive.all():
+            self.pos = self.pos[alive]
+            self.move = self.move[alive]
+            self.age = self.age[alive]
+            self.max_age = self.max_age[alive]
+            self.color = self.color[alive]
+            self.length = self.length[alive]
+
+    def draw(self, screen, camera):
+        """draws every spark as a short line pointing backwards
+           along its movement, all in one pass over the pixel array.
+           Returns the screen rect around all sparks, or None"""
+        if len(self) == 0:
+            return None
+        speed = np.hypot(self.move[:,0], self.move[:,1])
+        speed[speed == 0] = 1
+        direction = self.move / speed[:,None]
+        steps = np.arange(10)
+        x = (self.pos[:,0,None] - camera.x - direction[:,0,None] * steps).astype(np.intp)
+        y = (self.pos[:,1,None] - camera.y - direction[:,1,None] * steps).astype(np.intp)
+        w, h = screen.get_size()
+        inside = (steps < self.length[:,None]) & (x >= 0) & (x < w) & (y >= 0) & (y < h)
+        colors = np.broadcast_to(self.color[:,None,:], x.shape + (3,))
+        pixels = pygame.surfarray.pixels3d(screen)
+        x, y = x[inside], y[inside]
+        pixels[x, y] = colors[inside]
+        del pixels # unlock screen
+        if len(x) == 0:
+            return None
+        x1, y1 = int(x.min()), int(y.min())
+        return pygame.Rect(x1, y1, int(x.max()) - x1 + 1, int(y.max()) - y1 + 1)
+
+
 class Explosion():
     
+    particles = None # the Particles of the Viewer, set in prepare_sprites
+
     def __init__(self, pos, red = 100, blue = 0, green = 0, dred = 5, dblue = 5,
                  dgreen = 5, minsparks=1, maxsparks=200, a1 = 0, a2 =360, max_age = 1):
         
+        maxsparks = minsparks + Viewer.governor.scale("sparks", maxsparks - minsparks)
+        if Game.particle_engine:
+            self.spawn_particles(pos, red, blue, green, dred, dblue, dgreen,
+                                 minsparks, maxsparks, a1, a2, max_age)
+            return
         for _ in range(minsparks,maxsparks):
             a = random.randint(int(a1),int(a2))
             v = pygame.math.Vector2(random.randint(50,250),0)
@@ -445,8 +867,30 @@ class Explosion():
                     c[farbe] = 0
                 if c[farbe] > 255:
                     c[farbe] = 255
-            print("sparkfarbe:", c)
-            Spark(pos = self.pos, max_age = self.max_age, move = v, angle = a, color = c)
+            Spark.spawn(pos = self.pos, max_age = self.max_age, move = v, angle = a, color = c)
+
+    def spawn_particles(self, pos, red, blue, green, dred, dblue, dgreen,
+                        minsparks, maxsparks, a1, a2, max_age):
+        """same sparks as the Spark loop, created all at once as arrays"""
+        n = maxsparks - minsparks
+        if n <= 0:
+            return
+        rng = Explosion.particles.rng
+        a = np.radians(rng.integers(int(a1), int(a2), n, endpoint=True))
+        speed = rng.integers(50, 250, n, endpoint=True)
+        # vectors point up, screen y points down
+        move = np.column_stack((np.cos(a) * speed, -np.sin(a) * speed)).astype(np.float32)
+        p = np.empty((n,2), dtype=np.float32)
+        p[:] = (pos.x, -pos.y)
+        c = np.column_stack((red + rng.integers(-dred, dred, n, endpoint=True),
+                             green + rng.integers(-dgreen, dgreen, n, endpoint=True),
+                             blue + rng.integers(-dblue, dblue, n, endpoint=True)))
+        c = np.clip(c, 0, 255).astype(np.uint8)
+        # black sparks would be invisible, they get a random color (see Spark)
+        black = ~c.any(axis=1)
+        c[black] = rng.integers(0, 255, (black.sum(), 3), endpoint=True)
+        length = rng.integers(5, 10, n, endpoint=True).astype(np.int8)
+        Explosion.particles.spawn(p, move, max_age, c, length)
             
 
 class Cannon(VectorSprite):
@@ -461,13 +905,21 @@ class Cannon(VectorSprite):
         #print("meine eigene nummer", self.number)
         #print("meine boss position", VectorSprite.numbers[self.bossnumber].pos)
     
+    images = {} # shared by all cannons, so the RotationCache can share too
+
+    @classmethod
+    def base_image(cls):
+        if "cannon" not in cls.images:
+            image = pygame.Surface((50,50))
+            pygame.draw.line(image, (100, 0, 0), (25,25), (50,25),5)
+            image.set_colorkey((0,0,0))
+            cls.images["cannon"] = image
+        return cls.images["cannon"]
+
     def create_image(self):
-        self.image = pygame.Surface((50,50))
-        pygame.draw.line(self.image, (100, 0, 0), (25,25), (50,25),5)
-        self.image.set_colorkey((0,0,0))
-        self.image.convert_alpha()
+        self.image = Cannon.base_image()
         self.rect = self.image.get_rect()
-        self.image0 = self.image.copy()
+        self.image0 = self.image
         
     def update(self, seconds):
         VectorSprite.update(self, seconds)
@@ -480,8 +932,8 @@ class Cannon(VectorSprite):
         if self.friend:
              # it's the cannon of player1
              if self.mouseaim:
-                  v = pygame.math.Vector2(pygame.mouse.get_pos()[0],
-                                       -pygame.mouse.get_pos()[1])
+                  x, y = Viewer.camera.to_world(Viewer.input.mouse)
+                  v = pygame.math.Vector2(x, -y)
                   diff =  self.pos - v
                   self.set_angle(-diff.angle_to(rightvector)+180)
              else:
@@ -520,7 +972,7 @@ class Cannon(VectorSprite):
                 # rocket should start at the tip of cannon barrel, not at cannon center
                 p = pygame.math.Vector2(25,0)
                 p.rotate_ip(self.angle)
-                EnemyRocket(pos=self.pos+p, angle = self.angle, move=m)
+                EnemyRocket.spawn(pos=self.pos+p, angle = self.angle, move=m)
         
 class Turret(VectorSprite):
     
@@ -540,17 +992,19 @@ class Refuel(VectorSprite):
     def _overwrite_parameters(self):
         self.bounce_on_edge = True
     
+    shades = tuple(range(100, 256, 10)) # blue
+    frames = Frames(lambda blue: make_text(msg = "fuel", fontcolor = (0,0,blue), fontsize = 40))
+
     def create_image(self):
-        self.image = make_text(msg = "fuel", fontcolor = (0,0,random.randint(100,255)), fontsize = 40)
-        self.image.set_colorkey((0,0,0))
-        self.image.convert_alpha()
+        self.frame = random.randrange(len(Refuel.shades))
+        self.image = Refuel.frames[Refuel.shades[self.frame]]
         self.rect = self.image.get_rect()
         
     def update(self, seconds):
         VectorSprite.update(self,seconds)
         if random.random() < 0.05:
-            target = pygame.math.Vector2(random.randint(0, Viewer.width),
-                                         random.randint(-Viewer.height,0))
+            target = pygame.math.Vector2(random.randint(0, Viewer.world_width),
+                                         random.randint(-Viewer.world_height,0))
             v =  target - self.pos
             v.normalize_ip()
             v *= 15
@@ -570,6 +1024,9 @@ class NumberSprite(VectorSprite):
         self.shrinkspeed = 5
         self.shrinkduration = 5
    
+    shades = ((80,0,180), (100,0,220), (130,0,200), (150,0,250))
+    frames = Frames(lambda state: make_text(msg = state[0], fontsize = state[1], fontcolor = state[2]))
+
     def create_image(self):
         ##make_text(msg="pygame is cool", fontcolor=(255, 0, 255), fontsize=42, font=None):
         
@@ -580,9 +1037,8 @@ class NumberSprite(VectorSprite):
         self.old = d
         self.size += d * self.sign
         #print("Size is :", self.size)
-        self.image = make_text(msg = self.msg, fontsize = self.size, fontcolor=(random.randint(80,150),0,random.randint(180,250))) 
-        self.image.set_colorkey((0,0,0))
-        self.image.convert_alpha()
+        self.frame = random.randrange(len(NumberSprite.shades))
+        self.image = NumberSprite.frames[(self.msg, self.size, NumberSprite.shades[self.frame])]
         self.rect = self.image.get_rect()
         
     def update(self, seconds):
@@ -594,7 +1050,7 @@ class NumberSprite(VectorSprite):
     
     
  
-class Guardian(VectorSprite):
+class Guardian(StoredSprite):
     
     def _overwrite_parameters(self):
         self.speed = random.randint(5,15)
@@ -613,16 +1069,17 @@ class Guardian(VectorSprite):
         self.rect = self.image.get_rect()
         
     def update(self, seconds):
-        VectorSprite.update(self, seconds)
+        StoredSprite.update(self, seconds)
         # ----
         #if random.random() < 0.05:
         #    self.move.rotate_ip(random.randint(0,360))
         # ----
         dist = self.anchor - self.pos
         if dist.length() > self.max_dist:
-            self.move = pygame.math.Vector2(dist.x,dist.y)
-            self.move.normalize_ip()
-            self.move *= self.speed
+            move = pygame.math.Vector2(dist.x,dist.y)
+            move.normalize_ip()
+            move *= self.speed
+            self.move = move # move is a copy from the EntityStore
             
         
 
@@ -640,8 +1097,9 @@ class Player(VectorSprite):
             self.color = (255,0,255)
         self.fuel = 1000
         self.hitpoints = Game.playerhitpoints
-        self.gravity = pygame.math.Vector2(0, -0.1)
+        self.gravity = pygame.math.Vector2(0, -3) # per second (was 0.1 per frame at 30 fps)
         self.oldpos = pygame.math.Vector2(self.pos.x,self.pos.y)
+        self.nextfire = 0 # playtime of the next salvo while fire is held
         #print("i am the Player, ", self.number)
         #print("Player.number:", self.number)
         #Cannon(bossnumber = self.number, sticky_with_boss = True)
@@ -661,34 +1119,55 @@ class Player(VectorSprite):
                 v.rotate_ip(b)
                 v += self.move
                 #Viewer.sounds["playershooting"].play()
-                Rocket(pos=p+t, move = v, angle = b, max_distance = Game.rocket_range,  bossnumber=self.number)
+                Rocket.spawn(pos=p+t, move = v, angle = b, max_distance = Game.rocket_range,  bossnumber=self.number)
+
+    def hold_fire(self, angle, now, seconds):
+        """fire while a key or button is held: Game.autofire salvos per
+           second of playtime (now), however long a step (seconds) is"""
+        if self.nextfire < now - seconds:
+            self.nextfire = now # was not held in the last step
+        while self.nextfire <= now + 1e-9:
+            self.fire(angle)
+            self.nextfire += 1 / Game.autofire
        
-    def move_forward(self):
-        v = pygame.math.Vector2(Game.playerspeed,0)
+    def move_forward(self, factor=1):
+        """thrust, factor is the step length in 1/30 seconds"""
+        v = pygame.math.Vector2(Game.playerspeed * factor,0)
         v.rotate_ip(self.angle)
         self.move += v
-        Flame(bossnumber=self.number, pos = self.pos, delta = 180)
+        if Viewer.governor.allow("flames"):
+            Flame.spawn(bossnumber=self.number, pos = self.pos, delta = 180)
         #if random.random() < 0.2:
             #Smoke(pos = self.pos, gravity = None, max_age=3.0)
     
-    def move_backward(self):
-        v = pygame.math.Vector2(Game.playerspeed,0)
+    def move_backward(self, factor=1):
+        v = pygame.math.Vector2(Game.playerspeed * factor,0)
         v.rotate_ip(self.angle)
         self.move -= v
-        Flame(bossnumber=self.number, pos = self.pos, delta = 30)
-        Flame(bossnumber=self.number, pos = self.pos, delta = -30)
+        if Viewer.governor.allow("flames"):
+            Flame.spawn(bossnumber=self.number, pos = self.pos, delta = 30)
+            Flame.spawn(bossnumber=self.number, pos = self.pos, delta = -30)
         
         
         
     
+    images = {} # {(color, tilesize): image} shared for the RotationCache
+
+    @classmethod
+    def base_image(cls, color):
+        key = (color, Game.tilesize)
+        if key not in cls.images:
+            image = pygame.Surface((Game.tilesize,Game.tilesize))
+            pygame.draw.polygon(image, color, ((0,0),(Game.tilesize,Game.tilesize//2),(0,Game.tilesize),(Game.tilesize//2,Game.tilesize//2)))
+            #pygame.draw.line(image, (self.rot, 0, 0), (25,25), (50,25),5)
+            image.set_colorkey((0,0,0))
+            cls.images[key] = image
+        return cls.images[key]
+
     def create_image(self):
-        self.image = pygame.Surface((Game.tilesize,Game.tilesize))
-        pygame.draw.polygon(self.image, self.color, ((0,0),(Game.tilesize,Game.tilesize//2),(0,Game.tilesize),(Game.tilesize//2,Game.tilesize//2)))
-        #pygame.draw.line(self.image, (self.rot, 0, 0), (25,25), (50,25),5)
-        self.image.set_colorkey((0,0,0))
-        self.image.convert_alpha()
+        self.image = Player.base_image(self.color)
         self.rect = self.image.get_rect()
-        self.image0 = self.image.copy()
+        self.image0 = self.image
         self.rot += self.rotdelta
         if self.rot > 255:
             self.rot = 255
@@ -705,68 +1184,512 @@ class Player(VectorSprite):
     def update(self, seconds):
         self.oldpos = pygame.math.Vector2(self.pos.x, self.pos.y)
         VectorSprite.update(self, seconds)
-        oldcenter = self.rect.center
-        self.create_image() 
-        self.rect.center = oldcenter
-        self.set_angle(self.angle)
+        image = Player.base_image(self.color)
+        if image is not self.image0: # the tile size changed
+            self.image0 = image
+        self.set_angle(self.angle) # rect follows the (new) image
         # gravity:
-        self.move += self.gravity
+        self.move += self.gravity * seconds
         if self.hitpoints > Game.playerhitpoints:
             self.hitpoints = Game.playerhitpoints
 
         
 class Tile(VectorSprite):
     
+    full_hitpoints = (200, 800, 100) # by tile_status: grey, golden, green
+    damage_buckets = 8 # pre-rendered damage states per tile_status
+    frames = Frames(lambda state: Tile.render_frame(*state))
+
     def _overwrite_parameters(self):
         #self.tile_status = 0
         self._layer = 1 # so that player will be over Tile, not below it
-        if self.tile_status == 0:
-            self.hitpoints, self.hitpoints_old = 200, 200
-        elif self.tile_status == 1:
-        #if random.random() < 0.1:
-            self.hitpoints, self.hitpoints_old = 800, 800
-        #    self.tile_status = 1
-        elif self.tile_status == 2:
-            self.hitpoints, self.hitpoints_old = 100, 100
-        #    self.tile_status = 2
-        
+        self.hitpoints = self.hitpoints_old = Tile.full_hitpoints[self.tile_status]
         self.static = True
+
+    def kill(self):
+        if self.alive():
+            Tile.grid.remove(self.gridx, self.gridy)
+        VectorSprite.kill(self)
     
     def update(self, seconds):
         VectorSprite.update(self, seconds)    
         if self.hitpoints < self.hitpoints_old:
-            oldcenter = self.rect.center
-            self.create_image()
-            self.rect.center = oldcenter
-            self.hiptoins_old = self.hitpoints_old
-    
+            self.hitpoints_old = self.hitpoints
+            if Tile.bucket(self.tile_status, self.hitpoints) != self.bucket:
+                oldcenter = self.rect.center
+                self.create_image()
+                self.rect.center = oldcenter
+
+    @staticmethod
+    def bucket(tile_status, hitpoints):
+        """damage bucket of hitpoints, from 0 (almost destroyed) to
+           damage_buckets - 1 (undamaged). Works on numpy arrays too"""
+        full = np.array(Tile.full_hitpoints)[tile_status]
+        return np.clip(hitpoints * Tile.damage_buckets // full, 0, Tile.damage_buckets - 1)
+
+    @staticmethod
+    def color(tile_status, bucket):
+        """only green tiles change their color (to red) with damage"""
+        if tile_status == 1:
+            return (255,165,0)
+        if tile_status == 2:
+            g = 255 * (bucket + 1) // Tile.damage_buckets
+            return (255 - g, g, 0)
+        return (100,100,100)
+
+    @staticmethod
+    def render_frame(tile_status, bucket, tilesize):
+        """paints one damage bucket of a tile, see Tile.frames"""
+        image = pygame.Surface((tilesize,tilesize))
+        image.fill(Tile.color(tile_status, bucket))
+        pygame.draw.rect(image, (255,255,255), (0,0,tilesize,tilesize), 1)
+        image.set_colorkey((0,0,0))
+        return image.convert()
+
     def create_image(self):
-        self.image = pygame.Surface((Game.tilesize,Game.tilesize))
-        if self.tile_status == 1:
-            color = (255,165,0)
-        elif self.tile_status == 2:
-            color = (0,255,0)
-            hppercent = self.hitpoints / 100
-            g = max(0, 255 * hppercent)
-            r = 255 - g
-            color = (r,g,0)
-        else:
-            c = max(0, 255-self.hitpoints)
-            c = min(255, 255-self.hitpoints) 
-            #print("c=",c)
-            color = (100,100,100)
-        self.image.fill(color)
-        pygame.draw.rect(self.image, (255,255,255), (0,0,Game.tilesize,Game.tilesize), 1)
-        self.image.set_colorkey((0,0,0))
-        self.image.convert_alpha()
-        self.image0 = self.image.copy()
+        self.bucket = int(Tile.bucket(self.tile_status, self.hitpoints))
+        self.image = self.image0 = Tile.frames[(self.tile_status, self.bucket, Game.tilesize)]
         self.rect = self.image.get_rect()
-        
-        
 
-       
-class Flame(VectorSprite):
+
+class TileGrid():
+    """grid index for tiles. Tiles sit on a fixed grid (cell x,y has
+       pos x*tilesize+10, -y*tilesize-30), so a screen rect maps
+       straight to the cells it overlaps, without looking at every tile"""
+
+    def __init__(self, lines=None):
+        self.cells = {} # {(x,y): Tile}
+        self.lines = lines # level array the tiles were made from
+
+    @staticmethod
+    def cell_rect(x, y):
+        """screen rect of cell x,y, same as rect of a Tile there"""
+        ts = Game.tilesize
+        return pygame.Rect(x*ts + 10 - ts//2, y*ts + 30 - ts//2, ts, ts)
+
+    @staticmethod
+    def cell_range(rect, ts=None):
+        """returns x1, y1, x2, y2 (inclusive) of all cells overlapping rect,
+           ts is the tile size (default Game.tilesize)"""
+        if ts is None:
+            ts = Game.tilesize
+        ox = 10 - ts//2
+        oy = 30 - ts//2
+        x1 = (rect.left - ox - ts) // ts + 1
+        y1 = (rect.top - oy - ts) // ts + 1
+        x2 = (rect.right - ox - 1) // ts
+        y2 = (rect.bottom - oy - 1) // ts
+        return x1, y1, x2, y2
+
+    def add(self, x, y, tile):
+        self.cells[(x,y)] = tile
+
+    def remove(self, x, y):
+        """a destroyed tile, it becomes "." in the level array too"""
+        self.cells.pop((x,y), None)
+        if self.lines is not None:
+            self.lines[y, x] = ord(".")
+
+    def clear(self):
+        self.cells = {}
+
+    def hide(self):
+        """takes all tiles out of their sprite groups without killing
+           them, so that they keep their hitpoints for show"""
+        tiles = list(self.cells.values())
+        for group in Tile.groups:
+            group.remove(*tiles)
+
+    def show(self):
+        """puts all tiles (back) into their sprite groups"""
+        tiles = list(self.cells.values())
+        for group in Tile.groups:
+            group.add(*tiles)
+
+    def discard(self):
+        """forgets all tiles for good, the level array is not touched"""
+        for tile in self.cells.values():
+            pygame.sprite.Sprite.kill(tile)
+            VectorSprite.numbers.pop(tile.number, None)
+        self.cells = {}
+
+    def collide(self, rect):
+        """returns all tiles overlapping rect"""
+        x1, y1, x2, y2 = TileGrid.cell_range(rect)
+        tiles = []
+        for y in range(y1, y2 + 1):
+            for x in range(x1, x2 + 1):
+                t = self.cells.get((x,y))
+                if t is not None:
+                    tiles.append(t)
+        return tiles
+
+    @staticmethod
+    def sweep(lines, start, end, ts=None):
+        """finds the first solid cell ("0", "1" or "2" in the level
+           array lines) on each line from start[i] to end[i] (arrays of
+           rect coordinates). All lines step at the same time from cell
+           border to cell border (DDA), so no cell on the way is skipped.
+           returns arrays x, y (-1 where nothing was hit) of the cells and
+           t, the hit point is start + (end - start) * t. ts is the tile
+           size (default Game.tilesize)"""
+        if ts is None:
+            ts = Game.tilesize
+        origin = np.array((10 - ts//2, 30 - ts//2)) # top left of cell 0,0
+        p0 = (start - origin) / ts # in cells
+        d = (end - origin) / ts - p0
+        cell = np.floor(p0).astype(int)
+        crossings = np.abs(np.floor(p0 + d).astype(int) - cell).sum(axis=1)
+        step = np.sign(d).astype(int)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            # t of the next cell border and t from one border to the next
+            tmax = np.where(step > 0, (cell + 1 - p0) / d,
+                            np.where(step < 0, (cell - p0) / d, np.inf))
+            tdelta = np.where(step != 0, np.abs(1 / d), np.inf)
+        n = len(start)
+        rows = np.arange(n)
+        hitx = np.full(n, -1)
+        hity = np.full(n, -1)
+        hitt = np.zeros(n)
+        t = np.zeros(n) # where the line entered its current cell
+        ytiles, xtiles = lines.shape
+        active = np.ones(n, dtype=bool)
+        for i in range(crossings.max() + 1):
+            x = cell[:,0]
+            y = cell[:,1]
+            inside = active & (x >= 0) & (x < xtiles) & (y >= 0) & (y < ytiles)
+            char = lines[y[inside], x[inside]]
+            solid = np.zeros(n, dtype=bool)
+            solid[inside] = (char >= ord("0")) & (char <= ord("2"))
+            hitx[solid] = x[solid]
+            hity[solid] = y[solid]
+            hitt[solid] = t[solid]
+            active &= ~solid & (i < crossings)
+            # ---- over the nearest border, x or y ----
+            axis = (tmax[:,1] < tmax[:,0]).astype(int)
+            t = np.where(active, tmax[rows, axis], t)
+            cell[rows[active], axis[active]] += step[rows[active], axis[active]]
+            tmax[rows[active], axis[active]] += tdelta[rows[active], axis[active]]
+        return hitx, hity, hitt
+
+
+class SpatialGrid():
+    """the sprites of one group in a SpatialHash, binned by the cell
+       of their rect center"""
+
+    def __init__(self):
+        self.cells = collections.defaultdict(set) # {(x, y): sprites}
+        self.where = {} # {sprite: (x, y)}
+        self.order = {} # {sprite: index in the group}
+        self.extent = 0 # biggest rect width or height
+
+    def update(self, group, size):
+        """moves only the sprites that changed cells or died"""
+        cells, where = self.cells, self.where
+        order = {}
+        extent = 0
+        for i, sprite in enumerate(group.sprites()):
+            order[sprite] = i
+            x, y, w, h = sprite.rect
+            if w > extent:
+                extent = w
+            if h > extent:
+                extent = h
+            key = ((x + w // 2) // size, (y + h // 2) // size) # cell of the center
+            old = where.get(sprite)
+            if old != key:
+                if old is not None:
+                    self.remove(sprite, old)
+                cells[key].add(sprite)
+                where[sprite] = key
+        if len(where) > len(order):
+            for sprite in [s for s in where if s not in order]:
+                self.remove(sprite, where.pop(sprite))
+        self.order = order
+        self.extent = extent
+
+    def remove(self, sprite, key):
+        cell = self.cells[key]
+        cell.discard(sprite)
+        if not cell:
+            del self.cells[key]
+
+
+class SpatialHash():
+    """broadphase for the sprite collision passes: a uniform grid of
+       size x size pixels (rect coordinates) with a SpatialGrid for each
+       sprite group. update once per step, after everything moved, then
+       pairs only looks at the cells near each sprite instead of testing
+       every sprite of one group against every sprite of the other"""
+
+    def __init__(self, size):
+        self.size = size
+        self.grids = {} # {group: SpatialGrid}
+
+    def update(self, groups):
+        for group in groups:
+            if group not in self.grids:
+                self.grids[group] = SpatialGrid()
+            self.grids[group].update(group, self.size)
+
+    def pairs(self, group_a, group_b):
+        """candidate pairs (a, b) of a sprite of group_a and a sprite of
+           group_b with overlapping rects, in the order of nested loops
+           over group_a and group_b (like spritecollide for each sprite
+           of group_a). Sprites killed since update are left out. Loops
+           over the smaller group and looks up the other one"""
+        grid_a = self.grids[group_a]
+        grid_b = self.grids[group_b]
+        swap = len(grid_a.order) > len(grid_b.order)
+        if swap:
+            grid_a, grid_b = grid_b, grid_a
+        size = self.size
+        cells = grid_b.cells
+        reach = grid_b.extent // 2 + 1 # a center in reach of the rect of a
+        found = []
+        for a in grid_a.order:
+            if not a.alive():
+                continue
+            rect = a.rect
+            x1, x2 = (rect.left - reach) // size, (rect.right + reach) // size
+            y1, y2 = (rect.top - reach) // size, (rect.bottom + reach) // size
+            for y in range(y1, y2 + 1):
+                for x in range(x1, x2 + 1):
+                    cell = cells.get((x, y))
+                    if cell is None:
+                        continue
+                    for b in cell:
+                        if rect.colliderect(b.rect) and b.alive():
+                            found.append((b, a) if swap else (a, b))
+        order_a = grid_b.order if swap else grid_a.order
+        order_b = grid_a.order if swap else grid_b.order
+        found.sort(key=lambda pair: (order_a[pair[0]], order_b[pair[1]]))
+        return found
+
+
+class TileCell():
+    """one solid cell of a Terrain. Looks enough like a Tile
+       (pos, tile_status, hitpoints) for the collision code in Viewer.run"""
+
+    def __init__(self, terrain, x, y):
+        self.terrain = terrain
+        self.x = x
+        self.y = y
+        self.tile_status = int(terrain.lines[y, x]) - ord("0")
+        ts = terrain.tilesize
+        self.pos = pygame.math.Vector2(x*ts + 10, -y*ts - 30)
+
+    @property
+    def hitpoints(self):
+        return self.terrain.hitpoints[self.y, self.x]
+
+    @hitpoints.setter
+    def hitpoints(self, value):
+        self.terrain.set_hitpoints(self.x, self.y, value)
+
+
+class Camera():
+    """the part of the world that is on screen. x, y is its top left
+       corner in rect coordinates (like sprite.rect, y grows downwards).
+       It follows the players and never leaves the world"""
+
+    def __init__(self, width, height):
+        self.x = 0
+        self.y = 0
+        self.width = width
+        self.height = height
+
+    @property
+    def rect(self):
+        return pygame.Rect(self.x, self.y, self.width, self.height)
+
+    def follow(self, positions):
+        """centers on the middle of positions (world Vector2, y negative)"""
+        if not positions:
+            return
+        mx = sum(p.x for p in positions) / len(positions)
+        my = -sum(p.y for p in positions) / len(positions)
+        self.x = int(max(0, min(mx - self.width / 2, Viewer.world_width - self.width)))
+        self.y = int(max(0, min(my - self.height / 2, Viewer.world_height - self.height)))
+
+    def to_world(self, screenpos):
+        """rect coordinates in the world of a position on screen"""
+        return screenpos[0] + self.x, screenpos[1] + self.y
+
+    def draw(self, screen, group, previous=None, alpha=1, doreturn=False):
+        """like group.draw(screen), but only sprites on screen and moved
+           by the camera. Sprites with screen_space stay where they are.
+           previous is {sprite number: old rect center}, sprites in it are
+           drawn alpha (0...1) of the way from there to their rect.
+           With doreturn, returns the screen rects drawn"""
+        view = self.rect
+        blits = []
+        for s in group.sprites():
+            if s.screen_space:
+                blits.append((s.image, s.rect))
+                continue
+            rect = s.rect
+            if previous is not None and s.number in previous:
+                x, y = previous[s.number]
+                rect = rect.move(round((x - rect.centerx) * (1 - alpha)),
+                                 round((y - rect.centery) * (1 - alpha)))
+            if view.colliderect(rect):
+                blits.append((s.image, rect.move(-self.x, -self.y)))
+        return screen.blits(blits, doreturn=doreturn)
+
+
+class Terrain():
+    """all tiles of a level pre-baked into surfaces, one for each chunk
+       of Game.chunk_tiles x Game.chunk_tiles cells. Tiles are grid cells
+       here, not sprites. Only chunks on screen have a surface, and only
+       cells whose hitpoints changed (or that were destroyed) are painted
+       again. The cells are the level array itself (legend see
+       make_level), destroyed tiles become "." in it."""
+
+    tile_hitpoints = np.array(Tile.full_hitpoints, dtype=np.int32)
+
+    def __init__(self):
+        self.lines = np.zeros((0,0), dtype=np.uint8)
+        self.hitpoints = np.zeros((0,0), dtype=np.int32)
+        self.chunks = {}  # {(cx,cy): Surface} of the chunks on screen
+        self.dirty = set()  # (x,y) of cells that need painting
+        self.tilesize = Game.tilesize # of the level array, set by load
+
+    @staticmethod
+    def tiles(lines):
+        """boolean array, True for every tile ("0", "1" or "2") in lines"""
+        return (lines >= ord("0")) & (lines <= ord("2"))
+
+    def load(self, lines):
+        """uses the level array lines as grid, chunks are painted when
+           they come on screen"""
+        self.lines = lines
+        self.tilesize = Game.tilesize
+        tiles = Terrain.tiles(lines)
+        status = np.where(tiles, lines - ord("0"), 0)
+        self.hitpoints = np.where(tiles, Terrain.tile_hitpoints[status], 0)
+        self.dirty = set()
+        self.chunks = {}
+        # one pixel block per tile_status and damage bucket (the same
+        # states as Tile.frames), the last one for empty cells
+        ts = self.tilesize
+        buckets = Tile.damage_buckets
+        colors = [Tile.color(status, bucket) for status in range(3) for bucket in range(buckets)]
+        self.stamps = np.zeros((len(colors) + 1, ts, ts, 3), dtype=np.uint8)
+        self.stamps[:-1] = np.array(colors, dtype=np.uint8)[:, None, None, :]
+        self.stamps[:-1, [0, -1], :] = 255
+        self.stamps[:-1, :, [0, -1]] = 255
+
+    def chunk_origin(self, cx, cy):
+        """rect coordinates of the top left corner of chunk cx, cy.
+           cell 0,0 starts at 10-ts//2, 30-ts//2 (see TileGrid)"""
+        ts = self.tilesize
+        size = Game.chunk_tiles * ts
+        return cx * size + 10 - ts//2, cy * size + 30 - ts//2
+
+    def paint_chunk(self, cx, cy):
+        """returns a new surface with all cells of chunk cx, cy painted
+           at once from a pixel array: every tile is a block of the
+           color of its damage bucket with a white border, empty cells
+           are black"""
+        ts = self.tilesize
+        n = Game.chunk_tiles
+        block = self.lines[cy*n:(cy+1)*n, cx*n:(cx+1)*n]
+        ytiles, xtiles = block.shape
+        tiles = Terrain.tiles(block)
+        status = np.where(tiles, block - ord("0"), 0)
+        bucket = Tile.bucket(status, self.hitpoints[cy*n:(cy+1)*n, cx*n:(cx+1)*n])
+        stamp = np.where(tiles, status * Tile.damage_buckets + bucket, len(self.stamps) - 1)
+        cells = self.stamps[stamp] # [y, x, row, column]
+        pixels = np.ascontiguousarray(cells.transpose(0, 2, 1, 3, 4))
+        picture = pygame.image.frombuffer(pixels, (xtiles * ts, ytiles * ts), "RGB")
+        image = pygame.Surface((n * ts, n * ts))
+        image.set_colorkey((0,0,0))
+        image.blit(picture, (0,0))
+        self.chunks[(cx, cy)] = image.convert()
+
+    def paint_cell(self, x, y):
+        n = Game.chunk_tiles
+        image = self.chunks.get((x // n, y // n))
+        if image is None:
+            return # painted with its chunk when it comes on screen
+        ts = self.tilesize
+        r = pygame.Rect(x % n * ts, y % n * ts, ts, ts)
+        char = self.lines[y, x]
+        if not ord("0") <= char <= ord("2"):
+            image.fill((0,0,0), r)
+            return
+        status = int(char) - ord("0")
+        bucket = int(Tile.bucket(status, self.hitpoints[y, x]))
+        image.blit(Tile.frames[(status, bucket, ts)], r)
+
+    def set_hitpoints(self, x, y, value):
+        char = self.lines[y, x]
+        if not ord("0") <= char <= ord("2"):
+            return
+        status = int(char) - ord("0")
+        old = self.hitpoints[y, x]
+        self.hitpoints[y, x] = value
+        if value <= 0:
+            self.lines[y, x] = ord(".")
+            self.dirty.add((x,y))
+        elif Tile.bucket(status, value) != Tile.bucket(status, old):
+            # painted again only when it enters the next damage bucket
+            self.dirty.add((x,y))
+
+    def dirty_rects(self, camera):
+        """screen rects of the cells that draw will paint again"""
+        ts = self.tilesize
+        ox, oy = self.chunk_origin(0, 0)
+        return [pygame.Rect(ox + x*ts - camera.x, oy + y*ts - camera.y, ts, ts)
+                for x, y in self.dirty]
+
+    def collide(self, rect):
+        """returns a TileCell for each solid cell overlapping rect"""
+        x1, y1, x2, y2 = TileGrid.cell_range(rect, self.tilesize)
+        x1 = max(0, x1)
+        y1 = max(0, y1)
+        if x2 < x1 or y2 < y1:
+            return []
+        ys, xs = np.nonzero(Terrain.tiles(self.lines[y1:y2+1, x1:x2+1]))
+        return [TileCell(self, x1 + int(x), y1 + int(y)) for y, x in zip(ys, xs)]
+
+    def draw(self, screen, camera):
+        """repaints dirty cells, forgets chunks that left the screen,
+           paints chunks that came on screen and blits them"""
+        ts = self.tilesize
+        n = Game.chunk_tiles
+        size = n * ts
+        ox, oy = self.chunk_origin(0, 0)
+        ytiles, xtiles = self.lines.shape
+        view = camera.rect
+        xs = range(max(0, (view.left - ox) // size),
+                   min((xtiles - 1) // n, (view.right - 1 - ox) // size) + 1)
+        ys = range(max(0, (view.top - oy) // size),
+                   min((ytiles - 1) // n, (view.bottom - 1 - oy) // size) + 1)
+        visible = [(cx, cy) for cy in ys for cx in xs]
+        for key in set(self.chunks).difference(visible):
+            del self.chunks[key]
+        for x, y in self.dirty:
+            self.paint_cell(x, y)
+        self.dirty = set()
+        blits = []
+        for cx, cy in visible:
+            if (cx, cy) not in self.chunks:
+                self.paint_chunk(cx, cy)
+            x, y = self.chunk_origin(cx, cy)
+            blits.append((self.chunks[(cx, cy)], (x - camera.x, y - camera.y)))
+        screen.blits(blits, doreturn=False)
+
+
+class Flame(StoredSprite):
     """ engine flame for spaceship"""    
+
+    def recycle_image(self):
+        """a recycled flame keeps its (random) colors"""
+        self.image = self.image0
+        self.rect = self.image.get_rect()
+
     def _overwrite_parameters(self):
         self.sticky_with_boss = True
         self.max_age = 0.01
@@ -789,7 +1712,7 @@ class Flame(VectorSprite):
         self.rect = self.image.get_rect()
         
     def update(self, seconds):
-        VectorSprite.update(self, seconds)
+        StoredSprite.update(self, seconds)
         try:
             self.set_angle(VectorSprite.numbers[self.bossnumber].angle-self.delta)
         except:
@@ -822,7 +1745,9 @@ class Smoke(VectorSprite):
 
 
 
-class Rocket(VectorSprite):
+class Rocket(StoredSprite):
+
+    nose = 5 # pixel from center to tip, the tip hits tiles
 
     #def __init__(self, **kwargs):
     #    self.readyToLaunchTime = 0
@@ -845,27 +1770,429 @@ class Rocket(VectorSprite):
 
 
 
+    images = {} # {color: image} shared for the RotationCache
+
+    @classmethod
+    def base_image(cls, color):
+        if color not in cls.images:
+            image = pygame.Surface((10,5))
+            pygame.draw.polygon(image, color,
+                [(0,0),(7,0),(10,2),(10,3),(7,4),(0,4)])
+            image.set_colorkey((0,0,0))
+            cls.images[color] = image
+        return cls.images[color]
+
     def create_image(self):
-        self.image = pygame.Surface((10,5))
-        pygame.draw.polygon(self.image, self.color,
-            [(0,0),(7,0),(10,2),(10,3),(7,4),(0,4)])
-        self.image.set_colorkey((0,0,0))
-        self.image.convert_alpha()
-        self.image0 = self.image.copy()
+        self.image = Rocket.base_image(tuple(self.color))
+        self.image0 = self.image
         self.rect = self.image.get_rect()
         
 
 class EnemyRocket(Rocket):
     
+    images = {}
+
     def create_image(self):
-        self.image = pygame.Surface((10,5))
-        pygame.draw.polygon(self.image, (255, 0, 128),
-            [(0,0),(7,0),(10,2),(10,3),(7,4),(0,4)])
-        self.image.set_colorkey((0,0,0))
-        self.image.convert_alpha()
-        self.image0 = self.image.copy()
+        self.image = EnemyRocket.base_image((255, 0, 128))
+        self.image0 = self.image
         self.rect = self.image.get_rect()
     
+class FrameProfiler():
+    """times the phases of every frame of Viewer.run (events, update,
+       each collision pass, draw, ...). Keeps rolling averages and the
+       worst time of each phase for an on-screen overlay and records
+       the phases as chrome trace events (see chrome://tracing)"""
+
+    def __init__(self, window=120, maxframes=3000):
+        self.window = window # frames for rolling average and worst time
+        self.times = {} # {phase: deque of milliseconds per frame}
+        self.current = {} # {phase: milliseconds so far in this frame}
+        self.events = collections.deque(maxlen=maxframes * 20) # trace events
+        self.visible = False
+        self.lines = [] # overlay text, refreshed every few frames
+        self.frame = 0
+        self.phase = None
+        self.phasestart = 0
+        self.framestart = 0
+        self.origin = time.perf_counter()
+
+    def begin_frame(self, phase):
+        self.framestart = self.phasestart = time.perf_counter()
+        self.phase = phase
+
+    def mark(self, phase):
+        """ends the running phase and starts phase"""
+        now = time.perf_counter()
+        self.record(self.phase, self.phasestart, now)
+        self.phase = phase
+        self.phasestart = now
+
+    def end_frame(self):
+        """adds up each phase of the frame (Viewer.step runs 0 or more
+           times per frame) and appends the sums, 0 for missing phases"""
+        now = time.perf_counter()
+        self.record(self.phase, self.phasestart, now)
+        self.record("frame", self.framestart, now)
+        for phase in self.current:
+            if phase not in self.times:
+                self.times[phase] = collections.deque(maxlen=self.window)
+        for phase, times in self.times.items():
+            times.append(self.current.get(phase, 0))
+        self.current = {}
+        self.phase = None
+        self.frame += 1
+        if self.visible and self.frame % 15 == 0:
+            self.refresh_lines()
+
+    def record(self, phase, start, end):
+        self.current[phase] = self.current.get(phase, 0) + (end - start) * 1000
+        self.events.append({"name": phase, "ph": "X", "pid": 1,
+                            "tid": 0 if phase == "frame" else 1,
+                            "ts": (start - self.origin) * 1000000,
+                            "dur": (end - start) * 1000000})
+
+    def refresh_lines(self):
+        self.lines = ["{:<22} {:>7} {:>7}".format("phase (ms)", "avg", "worst")]
+        for phase, times in self.times.items():
+            self.lines.append("{:<22} {:7.2f} {:7.2f}".format(
+                phase, sum(times) / len(times), max(times)))
+
+    def toggle(self):
+        self.visible = not self.visible
+        self.refresh_lines()
+
+    def draw(self, screen):
+        """returns the rect of the overlay, or None"""
+        if not self.visible:
+            return None
+        rect = pygame.draw.rect(screen, (0,0,0), (5, 28, 330, 4 + len(self.lines) * 16))
+        for y, line in enumerate(self.lines):
+            write(screen, line, x=10, y=30 + y*16, fontsize=14, color=(255,255,255))
+        return rect
+
+    def export(self, filename):
+        """writes the recorded frames as chrome trace event json"""
+        with open(filename, "w") as f:
+            json.dump({"traceEvents": list(self.events),
+                       "displayTimeUnit": "ms"}, f)
+        print("trace written to", filename)
+
+class LoadGovernor():
+    """protects the frame budget of Viewer.run: measures the work time
+       of every frame and lowers the quality level when frames take
+       longer than 1000/fps milliseconds, raises it again when there
+       is time to spare. Effects ask the governor how much of them
+       they may spawn and it counts how often each one was throttled.
+       Only eye candy is scaled, never the simulation"""
+
+    levels = (1.0, 0.75, 0.5, 0.35, 0.25, 0.1) # quality, from best to worst
+    hold = 15 # frames between two changes of the level
+
+    def __init__(self, fps):
+        self.budget = 1000 / fps # milliseconds per frame
+        self.level = 0
+        self.average = 0 # rolling average of the frame time
+        self.frames = 0
+        self.credit = {} # {effect: fraction of a spawn not yet allowed}
+        self.throttled = {} # {effect: how often it was throttled}
+
+    @property
+    def quality(self):
+        return LoadGovernor.levels[self.level]
+
+    def frame(self, milliseconds):
+        """measures one frame and changes the level at most every hold frames"""
+        self.average = 0.9 * self.average + 0.1 * milliseconds
+        self.frames += 1
+        if not Game.load_governor or self.frames < LoadGovernor.hold:
+            return
+        if self.average > self.budget and self.level < len(LoadGovernor.levels) - 1:
+            self.level += 1
+            self.frames = 0
+        elif self.average < self.budget * 0.6 and self.level > 0:
+            self.level -= 1
+            self.frames = 0
+
+    def scale(self, effect, n):
+        """how many of n (sparks, tail points, ...) to make"""
+        allowed = int(n * self.quality)
+        if n > 0:
+            allowed = max(1, allowed)
+        if allowed < n:
+            self.throttled[effect] = self.throttled.get(effect, 0) + 1
+        return allowed
+
+    def allow(self, effect):
+        """for effects spawned one at a time (flames): True for about
+           quality of all calls, without using random numbers"""
+        credit = self.credit.get(effect, 0) + self.quality
+        if credit >= 1:
+            self.credit[effect] = credit - 1
+            return True
+        self.credit[effect] = credit
+        self.throttled[effect] = self.throttled.get(effect, 0) + 1
+        return False
+
+    def limit(self, effect, group, n):
+        """kills the oldest sprites of group above a scaled n"""
+        sprites = group.sprites()
+        allowed = max(1, int(n * self.quality))
+        if len(sprites) <= allowed:
+            return
+        self.throttled[effect] = self.throttled.get(effect, 0) + 1
+        for sprite in sprites[:len(sprites) - allowed]:
+            sprite.kill()
+
+    def text(self):
+        return "quality: {:.0%} throttled: {}".format(self.quality,
+            " ".join("{} {}".format(k, v) for k, v in sorted(self.throttled.items())) or "-")
+
+class DirtyScreen():
+    """dirty rect rendering for Viewer.run. The background and the
+       terrain are kept in a backdrop surface. Every frame only the rects
+       drawn in the frame before are erased from the backdrop, and only
+       those and the rects drawn now are pushed with display.update.
+       The whole screen is drawn and flipped when the camera moved, the
+       level changed (invalidate) or more than Game.dirty_max_area of
+       the screen changed"""
+
+    def __init__(self, screen):
+        self.screen = screen
+        self.backdrop = screen.copy()
+        self.key = None # what the backdrop shows
+        self.full = True # draw and flip the whole screen this frame
+        self.old = [] # rects drawn in the last frame
+        self.drawn = [] # rects drawn in this frame
+        self.flips = 0 # frames pushed as a whole
+        self.updates = 0 # frames pushed as rects
+        self.pixels = 0 # pushed to the display, in all frames
+
+    def invalidate(self):
+        self.full = True
+
+    def clear(self, background, terrain, camera):
+        """erases the last frame, terrain is None without Game.terrain_layer"""
+        key = (camera.x, camera.y, background, terrain)
+        if self.full or key != self.key:
+            self.backdrop.blit(background, (0,0))
+            if terrain is not None:
+                terrain.draw(self.backdrop, camera)
+            self.screen.blit(self.backdrop, (0,0))
+            self.key = key
+            self.full = True
+        else:
+            if terrain is not None and terrain.dirty:
+                for r in terrain.dirty_rects(camera):
+                    self.backdrop.set_clip(r)
+                    self.backdrop.blit(background, (0,0))
+                    terrain.draw(self.backdrop, camera)
+                    self.old.append(r)
+                self.backdrop.set_clip(None)
+            self.screen.blits([(self.backdrop, r, r) for r in self.old], doreturn=False)
+        self.drawn = []
+
+    def add(self, rects):
+        self.drawn.extend(rects)
+
+    def present(self):
+        w, h = self.screen.get_size()
+        rects = self.old + self.drawn
+        area = 0
+        if not self.full:
+            screen = self.screen.get_rect()
+            rects = [r.clip(screen) for r in rects]
+            area = sum(r.width * r.height for r in rects)
+        if self.full or area > Game.dirty_max_area * w * h:
+            pygame.display.flip()
+            self.flips += 1
+            self.pixels += w * h
+        else:
+            pygame.display.update(rects)
+            self.updates += 1
+            self.pixels += area
+        self.old = self.drawn
+        self.full = False
+
+    def __str__(self):
+        w, h = self.screen.get_size()
+        frames = self.flips + self.updates
+        return "dirty rects: {} of {} frames as rects, {:.0%} of the pixels pushed".format(
+               self.updates, frames, self.pixels / max(1, frames * w * h))
+
+class JoystickInput():
+    """joystick state from JOYBUTTON*, JOYHATMOTION and JOYDEVICE*
+       events instead of polling every button every frame. Each device
+       (numbered in the order they were plugged in) is one int: bit b
+       for button b, HAT_* bits for hat 0. Game.joystick_bindings maps
+       buttons and hat directions to commands. Every change is recorded
+       as (step, device, state) so that a session can be replayed"""
+
+    events = (pygame.JOYBUTTONDOWN, pygame.JOYBUTTONUP, pygame.JOYHATMOTION,
+              pygame.JOYDEVICEADDED, pygame.JOYDEVICEREMOVED)
+    HAT_UP, HAT_DOWN, HAT_LEFT, HAT_RIGHT = (1 << 32, 1 << 33, 1 << 34, 1 << 35)
+    HAT_BITS = HAT_UP | HAT_DOWN | HAT_LEFT | HAT_RIGHT
+    hat_names = {"up": HAT_UP, "down": HAT_DOWN, "left": HAT_LEFT, "right": HAT_RIGHT}
+
+    def __init__(self, bindings):
+        # {bit: command}, bindings keys are button numbers or hat directions
+        self.bindings = {JoystickInput.hat_names[key] if isinstance(key, str) else 1 << key: command
+                         for key, command in bindings.items()}
+        self.joysticks = {} # {instance_id: Joystick}
+        self.devices = {} # {instance_id: device number}
+        self.states = {} # {device number: bitmask}
+        self.commands = {} # {device number: [command, ...] of the held bits}
+        self.recording = [] # [(step, device, state), ...] since take_recording
+        pygame.joystick.init()
+        for index in range(pygame.joystick.get_count()):
+            self.add(index)
+
+    def add(self, index):
+        joystick = pygame.joystick.Joystick(index)
+        joystick.init()
+        instance = joystick.get_instance_id()
+        if instance not in self.joysticks:
+            self.joysticks[instance] = joystick
+            # the lowest free number, a replugged joystick gets its old player
+            numbers = set(self.devices.values())
+            self.devices[instance] = min(n for n in range(len(numbers) + 1) if n not in numbers)
+
+    def handle(self, event, step):
+        """changes the state of one device, step is the last simulation step"""
+        if event.type == pygame.JOYDEVICEADDED:
+            self.add(event.device_index)
+            return
+        device = self.devices.get(event.instance_id)
+        if device is None:
+            return
+        state = self.states.get(device, 0)
+        if event.type == pygame.JOYDEVICEREMOVED:
+            self.set_state(device, 0, step)
+            del self.joysticks[event.instance_id]
+            del self.devices[event.instance_id]
+            return
+        if event.type == pygame.JOYBUTTONDOWN:
+            state |= 1 << event.button
+        elif event.type == pygame.JOYBUTTONUP:
+            state &= ~(1 << event.button)
+        elif event.hat == 0:
+            x, y = event.value
+            state &= ~JoystickInput.HAT_BITS
+            state |= ((JoystickInput.HAT_UP if y == 1 else 0) | (JoystickInput.HAT_DOWN if y == -1 else 0) |
+                      (JoystickInput.HAT_LEFT if x == -1 else 0) | (JoystickInput.HAT_RIGHT if x == 1 else 0))
+        self.set_state(device, state, step)
+
+    def set_state(self, device, state, step):
+        if state == self.states.get(device, 0):
+            return
+        self.states[device] = state
+        self.commands[device] = [command for bit, command in self.bindings.items() if state & bit]
+        self.recording.append((step, device, state))
+
+    def take_recording(self):
+        """returns the state changes since the last call and forgets them"""
+        recording = self.recording
+        self.recording = []
+        return recording
+
+    def release_all(self, step):
+        """after the menu, which does not handle joystick events"""
+        for device in list(self.states):
+            self.set_state(device, 0, step)
+
+class InputFrame():
+    """the input of one frame. The game reads Viewer.input instead of
+       asking pygame, so that a replay can feed in recorded input.
+       keys: {key: pressed} of the keys polled every step, mouse: (x, y),
+       buttons: (left, middle, right), keydowns: pressed keys,
+       joystick: [(device, state), ...] changes of JoystickInput"""
+
+    polled_keys = (pygame.K_a, pygame.K_d, pygame.K_w, pygame.K_s, pygame.K_LSHIFT,
+                   pygame.K_RSHIFT, pygame.K_UP, pygame.K_DOWN, pygame.K_LEFT, pygame.K_RIGHT)
+
+    def __init__(self, milliseconds=0, level=0, keys=None, mouse=(0,0),
+                 buttons=(False, False, False), keydowns=(), joystick=()):
+        self.milliseconds = milliseconds # frame time
+        self.level = level # of the LoadGovernor
+        self.keys = keys if keys is not None else dict.fromkeys(InputFrame.polled_keys, False)
+        self.mouse = mouse
+        self.buttons = buttons
+        self.keydowns = keydowns
+        self.joystick = joystick
+
+    @classmethod
+    def live(cls, milliseconds, level, keydowns, joystick):
+        """the input of this frame from pygame"""
+        pressed = pygame.key.get_pressed()
+        return cls(milliseconds, level, {key: pressed[key] for key in InputFrame.polled_keys},
+                   pygame.mouse.get_pos(), pygame.mouse.get_pressed(), keydowns, joystick)
+
+class SessionLog():
+    """a recorded session (--record, --replay): the seed of all random
+       numbers and the settings in a header, then the InputFrame of
+       every frame. Binary, little endian, layout see the structs"""
+
+    MAGIC = b"CAVE"
+    VERSION = 1
+    # magic, version, random seed, width, height, fps, sim_rate, world_screens, level_seeds
+    HEADER = struct.Struct("<4sBQHHHHBB3q")
+    # milliseconds, governor level, polled keys, mouse x, y, mouse buttons,
+    # number of keydowns, number of joystick changes
+    FRAME = struct.Struct("<dBHhhBHH")
+    KEY = struct.Struct("<i")
+    JOY = struct.Struct("<BQ") # device, state
+
+    def __init__(self, filename, mode):
+        self.file = open(filename, mode + "b")
+        self.frames = 0
+
+    @classmethod
+    def create(cls, filename, width, height, fps):
+        """starts recording with the settings of Game"""
+        log = cls(filename, "w")
+        log.file.write(cls.HEADER.pack(cls.MAGIC, cls.VERSION, Game.random_seed, width, height,
+                                       fps, Game.sim_rate, *Game.world_screens, *Game.level_seeds))
+        return log
+
+    @classmethod
+    def open(cls, filename):
+        """opens a log for replay and sets its settings in Game. The
+           window size and fps are in width, height and fps"""
+        log = cls(filename, "r")
+        (magic, version, Game.random_seed, log.width, log.height, log.fps, Game.sim_rate,
+         wx, wy, *seeds) = cls.HEADER.unpack(log.file.read(cls.HEADER.size))
+        if magic != cls.MAGIC or version != cls.VERSION:
+            raise ValueError("{} is not a session log of version {}".format(filename, cls.VERSION))
+        Game.world_screens = (wx, wy)
+        Game.level_seeds = seeds
+        return log
+
+    def write_frame(self, frame):
+        keys = sum(1 << i for i, key in enumerate(InputFrame.polled_keys) if frame.keys[key])
+        buttons = sum(1 << i for i, pushed in enumerate(frame.buttons) if pushed)
+        data = [SessionLog.FRAME.pack(frame.milliseconds, frame.level, keys, *frame.mouse, buttons,
+                                      len(frame.keydowns), len(frame.joystick))]
+        data.extend(SessionLog.KEY.pack(key) for key in frame.keydowns)
+        data.extend(SessionLog.JOY.pack(device, state) for device, state in frame.joystick)
+        self.file.write(b"".join(data))
+        self.frames += 1
+
+    def read_frame(self):
+        """the next InputFrame, or None at the end of the log"""
+        data = self.file.read(SessionLog.FRAME.size)
+        if len(data) < SessionLog.FRAME.size:
+            return None
+        milliseconds, level, keys, x, y, buttons, nkeys, njoy = SessionLog.FRAME.unpack(data)
+        keydowns = [k for (k,) in SessionLog.KEY.iter_unpack(self.file.read(nkeys * SessionLog.KEY.size))]
+        joystick = list(SessionLog.JOY.iter_unpack(self.file.read(njoy * SessionLog.JOY.size)))
+        self.frames += 1
+        return InputFrame(milliseconds, level,
+                          {key: bool(keys >> i & 1) for i, key in enumerate(InputFrame.polled_keys)},
+                          (x, y), tuple(bool(buttons >> i & 1) for i in range(3)), keydowns, joystick)
+
+    def close(self):
+        self.file.close()
+
+
 class Game():
     
     menu = []
@@ -890,6 +2217,153 @@ class Game():
     circles = "none"
     rects = "none"
     peace = False
+    terrain_layer = True # tiles as cells of one pre-baked Terrain surface instead of Tile sprites
+    particle_engine = True # sparks as numpy Particles instead of Spark sprites
+    prewarm_rotations = True # rotate rockets, cannons and players in advance
+    level_seeds = [1, 2, 3] # one per level, levels are made from their seed
+    level_cache = "levelcache" # folder for generated levels, None for no cache
+    level_cache_files = 64 # most recently used levels kept in the cache
+    sim_rate = 30 # simulation steps per second, independent of the frame rate
+    max_steps = 5 # per frame, a slower computer plays in slow motion
+    autofire = 30 # salvos per second while fire is held
+    world_screens = (1, 1) # world size in window sizes (x, y), the Camera follows the players
+    chunk_tiles = 16 # a world chunk has chunk_tiles x chunk_tiles cells
+    hash_cell = 64 # cell size in pixels of the SpatialHash for the sprite collisions
+    near_chunks = 1 # sprites up to near_chunks from the screen or a player update every frame,
+    far_chunks = 4  # up to far_chunks only every far_update_every frame, the rest is frozen
+    far_update_every = 4
+    dirty_rects = True # push only the changed parts of the screen to the display
+    dirty_max_area = 0.5 # flip the whole screen when more of it changed
+    random_seed = None # for random and the sparks, set by --record and --replay
+    # joystick buttons (numbers) and hat directions to player commands
+    joystick_bindings = {0: "fire", 6: "cannon left", 7: "cannon right",
+                         "up": "forward", "down": "backward", "left": "rotate left", "right": "rotate right"}
+    load_governor = True # scale sparks, flames, flying texts and the mouse tail to hold the fps
+    max_flytexts = 20 # flying texts at the same time, at full quality
+
+def round_hole(lines, mx, my, r=5):
+    """fills a circle-shaped hole with '.' into lines,
+       center is (mx,my) radius is r
+    """
+    # same box and same rounding (half to even) as a loop over x and y
+    y1, y2 = max(0, my-r), min(lines.shape[0], my+r)
+    x1, x2 = max(0, mx-r), min(lines.shape[1], mx+r)
+    y, x = np.ogrid[y1:y2, x1:x2]
+    distance = np.hypot(mx-x, my-y)
+    lines[y1:y2, x1:x2][np.round(distance) < r] = ord(".")
+
+def rectangle_hole(lines, x, y, xlength, ylength):
+    """fills a rectangle-shaped hole with '.' into lines,
+       lower right corner is x,y"""
+    x -= xlength
+    y -= ylength
+    lines[max(0, y):y+ylength, max(0, x):x+xlength] = ord(".")
+
+def make_level(seed, level_nr, width, height, tilesize, rooms, holes):
+    """returns a new level: a numpy array (uint8, [y, x]) holding the
+       character code of each cell. The same arguments always make
+       the same level, all random numbers come from seed.
+       legend:
+      0.... grey tile
+      1.... golden tile
+      2.... green tile
+      ..... empty
+      @.... player start
+      !.... turret
+      +.... guardian
+      A.... teleport source
+      a.... teleport destination
+      Bb, Cc etc ... teleports
+      """
+    rng = np.random.default_rng(seed)
+    def randint(a, b):
+        return int(rng.integers(a, b, endpoint=True))
+    xtiles = (width-10) // tilesize
+    ytiles = (height-30) // tilesize
+    # 33 of 37 tiles are grey, 3 golden, 1 green
+    lines = rng.choice(np.array((ord("0"), ord("1"), ord("2")), dtype=np.uint8),
+                       size=(ytiles, xtiles), p=(33/37, 3/37, 1/37))
+    howmuch = {"none": 0,
+               "few" : 5,
+               "many": 10,
+               "lots": 15 }
+    # howmuch is per 1430 x 800 pixels of level, bigger worlds get more
+    windows = max(1, round(width * height / (1430 * 800)))
+    # ---- create rectangular room ----
+    for _ in range(howmuch[rooms] * windows):
+        rectangle_hole(lines, randint(0, xtiles), randint(0, ytiles), randint(5,10), randint(5,10))
+    # ---- create round room (hole) -------
+    for _ in range(howmuch[holes] * windows):
+        round_hole(lines, randint(5, xtiles-5), randint(5, ytiles-5), randint(2,5))
+    #round hole for player
+    round_hole(lines, xtiles//2, ytiles//2, 4)
+    #----- teleports
+    if level_nr == 0:
+        x, y = randint(0, xtiles-1), randint(0, ytiles-1)
+        lines[y, x] = ord("A")
+    elif level_nr == 1:
+        x, y = randint(0, xtiles-1), randint(0, ytiles-1)
+        lines[max(0, y-2):y+3, max(0, x-2):x+3] = ord(".")
+        lines[y, x] = ord("a")
+        x, y = randint(0, xtiles-1), randint(0, ytiles-1)
+        lines[y, x] = ord("B")
+    elif level_nr == 2:
+        x, y = randint(0, xtiles-1), randint(0, ytiles-1)
+        lines[max(0, y-2):y+3, max(0, x-2):x+3] = ord(".")
+        lines[y, x] = ord("b")
+    return lines
+
+def load_level(seed, level_nr, width, height, tilesize, rooms, holes, cache=True):
+    """like make_level, but levels are cached as .npy files in the
+       folder Game.level_cache (no cache if it is None or cache is False,
+       e.g. for the random seeds of the N key)"""
+    if Game.level_cache is None or not cache:
+        return make_level(seed, level_nr, width, height, tilesize, rooms, holes)
+    # v2: version of make_level, change it when make_level changes
+    version = "v2"
+    filename = os.path.join(Game.level_cache, "{}_{}_{}_{}x{}_{}_{}_{}.npy".format(
+               version, seed, level_nr, width, height, tilesize, rooms, holes))
+    try:
+        lines = np.load(filename)
+    except (OSError, ValueError):
+        pass
+    else:
+        try:
+            os.utime(filename) # recently used, see prune_level_cache
+        except OSError:
+            pass
+        return lines
+    lines = make_level(seed, level_nr, width, height, tilesize, rooms, holes)
+    try:
+        os.makedirs(Game.level_cache, exist_ok=True)
+        np.save(filename + ".tmp.npy", lines)
+        os.replace(filename + ".tmp.npy", filename)
+        prune_level_cache(version)
+    except OSError:
+        print("could not write level cache", filename)
+    return lines
+
+
+def prune_level_cache(version):
+    """deletes cached levels of other make_level versions and all but
+       the Game.level_cache_files most recently used ones"""
+    old = []
+    files = []
+    for name in os.listdir(Game.level_cache):
+        path = os.path.join(Game.level_cache, name)
+        if name.endswith(".tmp.npy"):
+            continue # could be written right now
+        if name.startswith(version + "_"):
+            files.append((os.path.getmtime(path), path))
+        else:
+            old.append(path)
+    files.sort(reverse=True)
+    for path in old + [path for mtime, path in files[Game.level_cache_files:]]:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass # pruned by the background worker at the same time
+
 
 class Viewer():
     width = 0
@@ -897,9 +2371,10 @@ class Viewer():
     sounds =   {}
     
 
-    def __init__(self, width=640, height=400, fps=30):
+    def __init__(self, width=640, height=400, fps=30, headless=False):
         """Initialize pygame, window, background, font,...
-           default arguments """
+           default arguments. headless: no window and no sound
+           (SDL dummy drivers), for benchmarks and servers"""
         self.helptext = """
         play with two joysticks
         rotate craft with pad
@@ -912,14 +2387,35 @@ class Viewer():
         reach level 3
         
         """
+        self.headless = headless
+        self.script = None # function(viewer, frame), called every frame by run
+        self.profiler = FrameProfiler()
+        self.tracefile = None # run exports the profiler trace here at the end
+        self.record = None # SessionLog that run writes every frame to
+        self.replay = None # SessionLog that run reads its input from
+        Viewer.input = InputFrame()
+        if Game.random_seed is not None:
+            random.seed(Game.random_seed)
+        if headless:
+            # must be set before pygame.init
+            os.environ["SDL_VIDEODRIVER"] = "dummy"
+            os.environ["SDL_AUDIODRIVER"] = "dummy"
         pygame.mixer.pre_init(44100, -16, 2, 2048)
         pygame.init()
+        # fonts and text surfaces of an earlier pygame.init are invalid
+        get_font.cache_clear()
+        render_text.cache_clear()
         Viewer.width = width    # make global readable
         Viewer.height = height
+        Viewer.world_width = width * Game.world_screens[0]
+        Viewer.world_height = height * Game.world_screens[1]
+        Viewer.camera = Camera(width, height)
+        Viewer.governor = LoadGovernor(fps)
         self.screen = pygame.display.set_mode((self.width, self.height), pygame.DOUBLEBUF)
         self.background = pygame.Surface(self.screen.get_size()).convert()
         self.background.fill((250,100,180)) # fill background white
         self.clock = pygame.time.Clock()
+        self.dirtyscreen = DirtyScreen(self.screen)
         self.fps = fps
         self.playtime = 0.0
         # ------ background images ------
@@ -951,26 +2447,39 @@ class Viewer():
         #Viewer.rocketchance = 0.001
         Viewer.wave = 0
         self.age = 0
-        # ------ joysticks ----
-        pygame.joystick.init()
-        self.joysticks = [pygame.joystick.Joystick(x) for x in range(pygame.joystick.get_count())]
-        for j in self.joysticks:
-            j.init()
-        self.levels = {}
-        #self.active_level = 0
-        for i in range(3):
-            self.active_level = i
-            self.generate_level()
-            self.levels[i] = self.lines
+        self.joystickinput = JoystickInput(Game.joystick_bindings)
+        self.levels = {}      # level_nr: lines, generated on first access
+        self.levelparams = {} # level_nr: load_level arguments of self.levels
+        self.prebuilding = {} # level_nr: (load_level arguments, future)
+        self.worker = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.seeds = dict(enumerate(Game.level_seeds))
         self.active_level = 0
             
         self.prepare_sprites()
-        self.lines = self.levels[0]
+        self.lines = self.get_level(0)
         self.paint_level() # painted current self.lines 
         self.prepare_sounds()
         self.loadbackground()
+        if Game.prewarm_rotations:
+            self.prewarm_rotations()
+        self.prerender_frames()
         Game.menu = Game.mainmenu[:]
 
+    def prerender_frames(self):
+        """renders the animation frames of the fuel sprite and the
+           damage buckets of the tiles in advance"""
+        Refuel.frames.prerender(Refuel.shades)
+        Tile.frames.prerender((status, bucket, Game.tilesize) for status in range(3)
+                              for bucket in range(Tile.damage_buckets))
+
+    def prewarm_rotations(self):
+        """fills the RotationCache with the fixed sprite images"""
+        for image in (Rocket.base_image((255,255,0)), Rocket.base_image((255,0,255)),
+                      EnemyRocket.base_image((255,0,128)), Cannon.base_image(),
+                      Player.base_image(self.player1.color),
+                      Player.base_image(self.player2.color)):
+            VectorSprite.rotations.prewarm(image)
+
     def next_song(self):
         self.song_index += 1
         if self.song_index >= len(self.songs):
@@ -995,178 +2504,190 @@ class Viewer():
         self.background.convert()
         
         
-    def round_hole(self, mx, my, r=5):
-        """fills a circle-shaped hole with '.' into self.lines,
-           center is (mx,my) radius is r
-        """
-        for y in range(my-r, my+r):
-            for x in range(mx-r, mx+r):
-                distance = ( (mx-x)**2 + (my-y)**2 ) ** 0.5
-                if round(distance,0) < r:
-                    self.lines[y][x] = "."
-
-               
-    def rectangle_hole(self, x, y, xlength, ylength):
-        """fills a rectangle-shaped hole with '.' into self.lines,
-           upper left corner is x,y"""
-        x -= xlength
-        y -= ylength
-        for y2 in range(y,y+ylength):
-            for x2 in range(x,x+xlength):
-                self.lines[y2][x2] = "."
-        
-            
-    def generate_level(self):
-        """legend:
-          0.... grey tile
-          1.... golden tile
-          2.... green tile
-          @.... player start
-          !.... turret
-          +.... guardian
-          A.... teleport source
-          a.... teleport destination
-          Bb, Cc etc ... teleports
-          """
-        xtiles = (Viewer.width-10) // Game.tilesize
-        ytiles = (Viewer.height-30) // Game.tilesize
-        self.lines = []
-        for y in range(ytiles):
-            line = []
-            for x in range(xtiles):
-                what = random.choice((0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,1,1,1,2))
-                line.append(str(what))
-            self.lines.append(line)
-        #print(self.lines) # level is in self.lines
-        howmuch = {"none": 0,
-                   "few" : 5,
-                   "many": 10,
-                   "lots": 15 }
-        
-        #------ kill all enemies -----
-        #for e in self.enemygroup:
-        #     e.kill()
-            
-                
-        # ---- create rectangular room ----
-        for _ in range(howmuch[Game.rooms]):
-            x = random.randint(0, len(line))
-            y = random.randint(0, len(self.lines))
-            w = random.randint(5,10)
-            h = random.randint(5,10)
-            self.rectangle_hole(x, y, w, h )
-            #if random.random() < 1:
-            #    Turret(pos=pygame.math.Vector2((x)*Game.tilesize, -(y)*Game.tilesize))
-            #if random.random() < 1:
-            #    xg = (x - w // 2 ) * Game.tilesize #+10
-            #    yg = (y - h // 2 ) * Game.tilesize #-30
-            #    Guardian(pos = pygame.math.Vector2(xg,-yg))
-        # ---- create round room (hole) -------
-        for _ in range(howmuch[Game.holes]):
-            self.round_hole(random.randint(5, len(line)-5), random.randint(5, len(self.lines)-5), random.randint(2,5))
-        #round hole for player
-        self.round_hole(len(line)//2, len(self.lines)//2, 4)
-        #self.round_hole(40,9, 8)
-        # circles
-        
-        # rects 
-        
-        #----- teleports
-        if self.active_level == 0:
-            #self.lines[random.randint(0,ytiles)][random.randint(0,xtiles)] = "A"
-            while True:
-                x=random.randint(0, xtiles)
-                y=random.randint(0, ytiles)
-                try: 
-                    char = self.lines[y][x]
-                except:
-                    continue
-                break
-            #if char in ".0":
-            self.lines[y][x] = "A"
-        elif self.active_level == 1:
-            while True:
-                x=random.randint(0, xtiles)
-                y=random.randint(0, ytiles)
-                try:
-                    char = self.lines[y][x]
-                except:
-                    continue
-                break
-            #if char in ".0":
-            
-            for dy in range(-2,3):
-                for dx in range(-2,3):
-                    try:
-                        self.lines[y+dy][x+dx] = "."
-                    except:
-                        pass
-            self.lines[y][x] = "a"
-            
-            
-            while True:
-                x=random.randint(0, xtiles)
-                y=random.randint(0, ytiles)
-                try:
-                    char = self.lines[y][x]
-                except:
-                    continue
-                break
-            
-            #if char in ".0":
-            self.lines[y][x] = "B"
-        elif self.active_level == 2:
-            while True:
-                x=random.randint(0, xtiles)
-                y=random.randint(0, ytiles)
-                try:
-                    char = self.lines[y][x]
-                except:
-                    continue
-                break
-            #if char in ".0":
-            for dy in range(-2,3):
-                for dx in range(-2,3):
-                    try:
-                        self.lines[y+dy][x+dx] = "."
-                    except:
-                        pass
-            
-            self.lines[y][x] = "b"
-        
-            
-        
-        # ---- cannon for each enemy1
-        #for e in self.enemygroup:
-        #    Cannon(bossnumber = e.number) 
-        #print("das ist self.lines")
-        #print(self.lines)
-        #self.levels.append(self.lines)        
-        #self.paint_level()
+    def level_params(self, level_nr):
+        """load_level arguments for level # level_nr with the current settings"""
+        return (self.seeds[level_nr], level_nr, Viewer.world_width, Viewer.world_height,
+                Game.tilesize, Game.rooms, Game.holes)
+
+    def generate_level(self, cache=True):
+        """self.lines becomes level number self.active_level, made from
+           its seed in self.seeds (see make_level for the legend)
+           and is painted. cache: see load_level"""
+        params = self.level_params(self.active_level)
+        self.lines = load_level(*params, cache=cache)
+        self.levels[self.active_level] = self.lines
+        self.levelparams[self.active_level] = params
+        self.prebuild(self.active_level + 1)
+        self.paint_level()
+
+    def get_level(self, level_nr):
+        """returns level # level_nr. it is generated on first access (or
+           taken from the background worker) and the next level starts
+           building in the background"""
+        params = self.level_params(level_nr)
+        if self.levelparams.get(level_nr) != params:
+            oldparams, future = self.prebuilding.pop(level_nr, (None, None))
+            if oldparams == params:
+                self.levels[level_nr] = future.result()
+            else: # not prebuilt, or prebuilt with other settings
+                self.levels[level_nr] = load_level(*params)
+            self.levelparams[level_nr] = params
+        self.prebuild(level_nr + 1)
+        return self.levels[level_nr]
+
+    def prebuild(self, level_nr):
+        """starts generating level # level_nr in the background worker"""
+        if level_nr not in self.seeds:
+            return
+        params = self.level_params(level_nr)
+        if self.levelparams.get(level_nr) == params:
+            return
+        if self.prebuilding.get(level_nr, (None,))[0] == params:
+            return
+        self.prebuilding[level_nr] = (params, self.worker.submit(load_level, *params))
                 
         
     def paint_level(self):
-         # kill old tiles 
-         for t in self.tilegroup:
-             t.kill()
-         # generate new tiles
-         for y, line in enumerate(self.lines):
-              for x, char in enumerate(line):
-                  p = pygame.math.Vector2(x*Game.tilesize + 10, -y*Game.tilesize - 30)
-                  if char == "0" or char=="1" or char =="2":
-                      Tile(pos=p, tile_status=int(char))
-                  elif char in "abcABC":
-                      NumberSprite(pos=p, msg=char)
-                      
-          #for x in range(10, Viewer.width, 20):
-          #  for y in range(30, Viewer.height, 20):
-          #      Tile(pos=pygame.math.Vector2(x, -y), color=(16,16,16))
+         """shows self.lines as level # self.active_level. Every level
+            keeps its Terrain (or Tile sprites) resident, so changing
+            back into a level only swaps them in, damage included. They
+            are only built again when the level array was generated anew
+            or the tile size changed"""
+         for n in self.numbergroup:
+             n.kill()
+         self.dirtyscreen.invalidate()
+         if Game.terrain_layer:
+             terrain = self.terrains.get(self.active_level)
+             if (terrain is None or terrain.lines is not self.lines
+                     or terrain.tilesize != Game.tilesize):
+                 terrain = Terrain()
+                 terrain.load(self.lines)
+                 self.terrains[self.active_level] = terrain
+             self.terrain = terrain
+         else:
+             grid = self.tilegrids.get(self.active_level)
+             stale = grid is not None and grid.lines is not self.lines
+             if stale:
+                 grid.discard() # level generated anew, never shown again
+             if self.tilegrid is not grid:
+                 self.tilegrid.hide() # of another level, kept for later
+             if grid is None or stale:
+                 grid = self.make_tilegrid()
+                 self.tilegrids[self.active_level] = grid
+             else:
+                 grid.show()
+             self.tilegrid = grid
+             Tile.grid = grid
+         teleports = np.isin(self.lines, [ord(c) for c in "abcABC"])
+         for y, x in zip(*np.nonzero(teleports)):
+             p = pygame.math.Vector2(int(x)*Game.tilesize + 10, -int(y)*Game.tilesize - 30)
+             NumberSprite(pos=p, msg=chr(self.lines[y, x]))
    
+    def update_sprites(self, seconds, frame):
+        """like self.allgroup.update(seconds), but sprites far away from
+           the screen and from every player are updated less often
+           (see Game.near_chunks) or not at all"""
+        size = Game.chunk_tiles * Game.tilesize
+        view = Viewer.camera.rect
+        players = [(p.pos.x, -p.pos.y) for p in self.playergroup]
+        slow = Game.far_update_every
+        for sprite in self.allgroup.sprites():
+            if sprite.screen_space:
+                sprite.update(seconds)
+                continue
+            if isinstance(sprite, StoredSprite):
+                continue # all at once, see below
+            x, y = sprite.pos.x, -sprite.pos.y
+            # distance in chunks to the screen or the nearest player
+            distance = max(view.left - x, x - view.right, view.top - y, y - view.bottom)
+            for px, py in players:
+                distance = min(distance, max(abs(x - px), abs(y - py)))
+            distance /= size
+            if distance <= Game.near_chunks:
+                sprite.update(seconds)
+            elif distance <= Game.far_chunks:
+                if (frame + sprite.number) % slow == 0:
+                    sprite.update(seconds * slow)
+        # stored sprites: the same distances, as arrays from the EntityStore.
+        # the store moves each slot by its own step, frozen slots stay
+        store = StoredSprite.store
+        slots = np.arange(len(store.sprites))
+        x = store.pos[:, 0]
+        y = -store.pos[:, 1]
+        distance = np.maximum.reduce((view.left - x, x - view.right,
+                                      view.top - y, y - view.bottom))
+        for px, py in players:
+            distance = np.minimum(distance, np.maximum(abs(x - px), abs(y - py)))
+        distance /= size
+        near = distance <= Game.near_chunks
+        far = ~near & (distance <= Game.far_chunks) & ((frame + slots) % slow == 0)
+        store.update(np.where(near, seconds, np.where(far, seconds * slow, 0.0)))
+        for slot in np.nonzero(store.active & near)[0]:
+            store.sprites[slot].update(seconds)
+        for slot in np.nonzero(store.active & far)[0]:
+            store.sprites[slot].update(seconds * slow)
+
+    def make_tilegrid(self):
+        """creates a Tile for every tile in self.lines, returns their TileGrid"""
+        grid = TileGrid(self.lines)
+        Tile.grid = grid
+        for y, x in zip(*np.nonzero(Terrain.tiles(self.lines))):
+            x, y = int(x), int(y)
+            p = pygame.math.Vector2(x*Game.tilesize + 10, -y*Game.tilesize - 30)
+            t = Tile(pos=p, tile_status=int(self.lines[y, x]) - ord("0"), gridx=x, gridy=y)
+            grid.add(x, y, t)
+        return grid
+
+    def rocket_hits(self):
+        """(rocket, tile, position) for every rocket that hit a tile in
+           the last step. The way of each rocket in that step (and its
+           nose) is swept through the grid, so even fast rockets can not
+           fly through a thin tile. All rockets at once"""
+        rockets = self.rocketgroup.sprites()
+        if not rockets:
+            return []
+        store = StoredSprite.store
+        slots = np.array([r.slot for r in rockets])
+        flip = np.array((1, -1)) # world to rect coordinates
+        pos = store.pos[slots] * flip
+        move = store.move[slots] * flip
+        # the step of each rocket in EntityStore.update (longer when far,
+        # 0 when frozen). rockets spawned after it did not move yet
+        start = pos - move * np.minimum(store.age[slots], store.seconds[slots])[:,None]
+        speed = np.maximum(np.hypot(move[:,0], move[:,1]), 1e-9)
+        end = pos + move / speed[:,None] * Rocket.nose
+        # the grid on screen, self.lines may be a level not painted yet
+        if Game.terrain_layer:
+            lines = self.terrain.lines
+            xs, ys, ts = TileGrid.sweep(lines, start, end, self.terrain.tilesize)
+        else:
+            lines = self.tilegrid.lines
+            xs, ys, ts = TileGrid.sweep(lines, start, end)
+        hits = []
+        for i in np.nonzero(xs >= 0)[0]:
+            x, y = int(xs[i]), int(ys[i])
+            if not ord("0") <= lines[y, x] <= ord("2"):
+                continue # only "0", "1" and "2" are tiles
+            if Game.terrain_layer:
+                tile = TileCell(self.terrain, x, y)
+            else:
+                tile = self.tilegrid.cells.get((x, y))
+                if tile is None:
+                    continue
+            hit = start[i] + (end[i] - start[i]) * ts[i]
+            hits.append((rockets[i], tile, pygame.math.Vector2(hit[0], -hit[1])))
+        return hits
+
+    def tilecollide(self, sprite):
+        """returns all tiles (or Terrain cells) touching the rect of sprite"""
+        if Game.terrain_layer:
+            return self.terrain.collide(sprite.rect)
+        return self.tilegrid.collide(sprite.rect)
+
     def change_level(self, level_nr):
         """changes into level # level_nr"""
-        self.lines = self.levels[level_nr]
-        for n in self.numbergroup:
-            n.kill()
+        self.active_level = level_nr
+        self.lines = self.get_level(level_nr)
         self.paint_level() # painted current self.lines 
                     
     def go_to_teleport(self, teleport):
@@ -1214,11 +2735,19 @@ class Viewer():
         Guardian.groups = self.allgroup, self.guardiangroup
         NumberSprite.groups = self.allgroup, self.numbergroup
         Refuel.groups = self.allgroup, self.fuelgroup
+        self.terrains = {}  # level_nr: Terrain, resident between level changes
+        self.terrain = Terrain()
+        self.tilegrids = {} # level_nr: TileGrid (of Tile sprites), same
+        self.tilegrid = TileGrid()
+        Tile.grid = self.tilegrid
+        self.particles = Particles(Game.random_seed)
+        self.spatialhash = SpatialHash(Game.hash_cell)
+        Explosion.particles = self.particles
 
    
         # ------ player1,2,3: mouse, keyboard, joystick ---
-        self.player1 =  Player(bounce_on_edge = True, pos=pygame.math.Vector2(Viewer.width/2-20,-Viewer.height/2))
-        self.player2 =  Player(bounce_on_edge = True, pos=pygame.math.Vector2(Viewer.width/2+20,-Viewer.height/2))
+        self.player1 =  Player(bounce_on_edge = True, pos=pygame.math.Vector2(Viewer.world_width/2-20,-Viewer.world_height/2))
+        self.player2 =  Player(bounce_on_edge = True, pos=pygame.math.Vector2(Viewer.world_width/2+20,-Viewer.world_height/2))
         self.cannon1 = Cannon(bossnumber=self.player1.number, mouseaim = False, friend = True)
         self.cannon2 = Cannon(bossnumber=self.player2.number, mouseaim = False, friend = True)
         self.fuel1 = Refuel()
@@ -1241,7 +2770,6 @@ class Viewer():
         #ytiles = (Viewer.height-30) // 20
         #self.generate_level(xtiles, ytiles)
         #self.paint_level()
-        self.generate_level()
         
         #for x in range(20):
         #    EvilMonster(bounce_on_edge=True)
@@ -1285,9 +2813,7 @@ class Viewer():
         running = True
         cursor = 0
         lastmenu = None
-        lines = self.helptext.splitlines()
-        for y, line in enumerate(lines):
-             Flytext(700, 500 + y*30, line, fontsize=50, duration=30, left_align=True)
+        self.show_helptext()
         while running:
             milliseconds = self.clock.tick(self.fps) #
             seconds = milliseconds / 1000# - self.menudeltatime
@@ -1444,9 +2970,23 @@ class Viewer():
                             
                         
             
+            seconds = self.clock.tick(self.fps) / 1000
+            self.draw_menu(cursor, seconds)
+        # --- menu fertig -----
+        # exit pygame
+        #pygame.mouse.set_visible(True)    
+        #pygame.quit()
+        return -1
+
+    def show_helptext(self):
+        lines = self.helptext.splitlines()
+        for y, line in enumerate(lines):
+             Flytext(700, 500 + y*30, line, fontsize=50, duration=30, left_align=True)
+
+    def draw_menu(self, cursor, seconds):
+            """draws one frame of the menu, cursor is the selected line"""
             # ----- celar all ----
             self.screen.blit(self.background, (0, 0))
-            seconds = self.clock.tick(self.fps) / 1000
             self.flytextgroup.update(seconds)
             self.flytextgroup.draw(self.screen)
             # draw status
@@ -1467,14 +3007,283 @@ class Viewer():
             c = random.randint(200, 255)   #, random.randint(0,255), random.randint(0,255))
             write(self.screen, "--->", x = 120, y = 100+cursor * 25, color = (c,0,c))
             pygame.display.flip()
-        # --- menu fertig -----
-        # exit pygame
-        #pygame.mouse.set_visible(True)    
-        #pygame.quit()
-        return -1
    
-    def run(self):
-        """The mainloop"""
+    def player_command(self, player, cannon, command, seconds):
+        """one step of a joystick command, see Game.joystick_bindings.
+           The amounts are per 1/30 seconds, scaled to the step"""
+        per30 = seconds * 30
+        if command == "fire":
+            if self.playtime > self.firesoundtime:
+                 Viewer.sounds["playershooting"].play()
+                 self.firesoundtime = self.playtime + 0.36
+            player.hold_fire(cannon.angle, self.playtime, seconds)
+        elif command == "cannon left":
+            cannon.delta_angle += 5 * per30
+        elif command == "cannon right":
+            cannon.delta_angle -= 5 * per30
+        elif command == "forward":
+            player.move_forward(per30)
+            player.fuel -= per30
+        elif command == "backward":
+            player.move_backward(per30)
+            player.fuel -= per30
+        elif command == "rotate left":
+            player.rotate(3 * per30)
+        elif command == "rotate right":
+            player.rotate(-3 * per30)
+
+    def step(self, seconds):
+        """one fixed step of the simulation (seconds is always
+           1/Game.sim_rate): input, movement and collisions"""
+        self.stepnumber += 1
+        self.playtime += seconds
+        # ------------ pressed keys ------
+        self.profiler.mark("keyboard")
+        pressed_keys = Viewer.input.keys
+        # turn, thrust and fuel were made for one step per frame at 30 fps
+        per30 = seconds * 30
+
+        # if pressed_keys[pygame.K_LSHIFT]:
+            # paint range circles for cannons
+        # ---------- player 2 ------------------
+        if pressed_keys[pygame.K_a]:
+            self.player2.rotate(3 * per30)
+        if pressed_keys[pygame.K_d]:
+            self.player2.rotate(-3 * per30)
+        if pressed_keys[pygame.K_w]:
+            if self.player2.fuel > 0:
+                self.player2.move_forward(per30)
+                self.player2.fuel -= per30
+        if pressed_keys[pygame.K_s]:
+            if self.player2.fuel > 0:
+                self.player2.move_backward(per30)
+                self.player2.fuel -= per30
+        if pressed_keys[pygame.K_LSHIFT]:
+            self.player2.hold_fire(self.cannon2.angle, self.playtime, seconds)
+
+        
+
+        # ------ mouse handler ------
+        left,middle,right = Viewer.input.buttons
+        
+        #if right:
+        #    self.player1.move_forward()
+        #if left:
+        #    self.player1.fire(self.cannon1.angle)
+        #if middle:
+        #    self.cannon1.mouseaim = True
+        #else:
+        #    self.cannon1.mouseaim = False
+        #    # rotate player1 toward mouse
+        #    mv = pygame.math.Vector2(pygame.mouse.get_pos()[0], -pygame.mouse.get_pos()[1])
+        #    diff = mv - self.player1.pos 
+        #    self.player1.angle = -diff.angle_to(pygame.math.Vector2(1,0))
+
+      
+        
+        #--------------------
+        # ------ joystick handler -------
+        self.profiler.mark("joystick")
+        for number, player, cannon in ((0, self.player1, self.cannon1),
+                                       (1, self.player2, self.cannon2)):
+            for command in self.joystickinput.commands.get(number, ()):
+                self.player_command(player, cannon, command, seconds)
+
+        self.profiler.mark("update")
+        self.update_sprites(seconds, self.stepnumber)
+        self.particles.update(seconds)
+        Viewer.camera.follow([p.pos for p in self.playergroup])
+
+
+        
+        # ======== collision detections ============
+        if 0 in VectorSprite.numbers:
+            #----- between Tile and player ------
+            self.profiler.mark("collide tile/player")
+            for p in self.playergroup:
+                crashgroup = self.tilecollide(p)
+                for t in crashgroup:
+                     # elastic_collision(p, m)
+                     t.hitpoints -= 1
+                     if t.tile_status == 2:
+                         #healing tile
+                        p.hitpoints += 1
+                        if self.playtime > self.playerhealingsoundtime:
+                            Viewer.sounds["playerhealing"].play()
+                            self.playerhealingsoundtime = self.playtime + 0.40
+                            
+                     else:
+                         p.hitpoints -= 1
+                         if self.playtime > self.groundhitsoundtime:
+                            Viewer.sounds["hitground"].play()
+                            self.groundhitsoundtime = self.playtime + 0.43
+                         Explosion(t.pos, red=200, dred=50, minsparks=1, maxsparks=2)
+                     
+                     
+                     # teleport player away from tile
+                     diff = p.pos - t.pos
+                     diff.normalize_ip()
+                     p.pos += diff * 6
+                     
+                     #elastic_collision(t,p)                    
+                     #v = p.move * -1
+                     #ok = True
+                     #try: 
+                     #   v.normalize_ip()
+                     #except:
+                     #    ok = False
+                     #if ok:
+                     #   v *= 4 # distance to wall
+                     #   p.pos += v
+                     #   #p.pos += (p.move * -1)
+                     #p.pos = pygame.math.Vector2(p.oldpos.x, p.oldpos.y)
+                     p.move = pygame.math.Vector2(0,0)
+                     p.rect.center = ( round(p.pos.x, 0), -round(p.pos.y, 0) )
+                     self.cannon1.update(0)
+                     #self.cannon1.pos = pygame.math.Vector2(p.pos.x, p.pos.y)
+                     #self.cannon1.center = p.rect.center
+                    
+            
+            
+            #------ between Tile and rocket ------
+            self.profiler.mark("collide tile/rocket")
+            for r, t, hitpos in self.rocket_hits():
+                #print("r.bossnr, t.tilest", r.bossnumber, t.tile_status)
+                if r.bossnumber == 0 or r.bossnumber == 1:
+                    if t.tile_status == 0:
+                        #print("hitting normal tile")
+                        # normal
+                        b1 = r.angle -45 + 180
+                        b2 = r.angle + 45 + 180
+                        if self.playtime > self.groundhitsoundtime:
+                            Viewer.sounds["hitground"].play()
+                            self.groundhitsoundtime = self.playtime + 0.43
+                        Explosion(hitpos, a1=b1, a2=b2, max_age=0.3, red=0, green=0, blue=0, dred=0, dgreen = 0, dblue = 0, minsparks=1, maxsparks=10)
+                        t.hitpoints -= r.damage
+                    elif t.tile_status == 1:
+                        # golden
+                        b1 = r.angle -45 + 180
+                        b2 = r.angle + 45 + 180
+                        if self.playtime > self.groundhitsoundtime:
+                            Viewer.sounds["hitground"].play()
+                            self.groundhitsoundtime = self.playtime + 0.43
+                        Explosion(hitpos, a1=b1, a2=b2, max_age=0.3, red=255, green=165, blue=0, dred=15, dgreen = 15, dblue = 15, minsparks=1, maxsparks=10)
+                        t.hitpoints -= r.damage
+                        if t.hitpoints <= 0:
+                            Game.gold += 1
+                    else:
+                        # healing
+                        if self.playtime > self.playerhealingsoundtime:
+                            Viewer.sounds["playerhealing"].play()
+                            self.playerhealingsoundtime = self.playtime + 0.40
+                        VectorSprite.numbers[r.bossnumber].hitpoints += r.damage    
+                        b1 = r.angle -45 + 180
+                        b2 = r.angle + 45 + 180
+                        Explosion(hitpos, a1=b1, a2=b2, max_age=0.3, red=0, green=255, blue=0, dred=15, dgreen = 15, dblue = 15, minsparks=1, maxsparks=10)
+                        t.hitpoints -= r.damage
+                r.kill()
+            
+            #------ broadphase for the sprite passes ------
+            self.profiler.mark("spatial hash")
+            self.spatialhash.update((self.playergroup, self.rocketgroup, self.enemygroup,
+                                     self.fuelgroup, self.numbergroup))
+            
+            #------ between player and rocket ------
+            self.profiler.mark("collide player/rocket")
+            for p, r in self.spatialhash.pairs(self.playergroup, self.rocketgroup):
+                if not r.alive():
+                    continue # killed by the other player
+                if r.bossnumber != 0 and r.bossnumber != 1:
+                    p.hitpoints -= r.damage
+                    b1 = r.angle -45 + 180
+                    b2 = r.angle + 45 + 180
+                    if self.playtime > self.playerdamagesoundtime:
+                        Viewer.sounds["playerdamage"].play()
+                        self.playerdamagesoundtime = self.playtime + 0.55
+                    Explosion(r.pos, a1=b1, a2=b2, max_age=0.3, red=200, dred=50, minsparks=1, maxsparks=2)
+                    r.kill()
+            
+            #------ between player and Refuel --------
+            self.profiler.mark("collide player/fuel")
+            for p, f in self.spatialhash.pairs(self.playergroup, self.fuelgroup):
+                p.fuel += 10
+                    
+            
+            #------ between player and NumberSprite ------
+            self.profiler.mark("collide player/number")
+            for p, n in self.spatialhash.pairs(self.playergroup, self.numbergroup):
+                if not n.alive():
+                    continue # the level changed
+                if n.msg == "A":
+                    # teleport to level 1
+                    self.change_level(level_nr = 1)
+                    self.go_to_teleport(teleport = "a")
+                elif n.msg == "B":
+                    # teleport to level 2
+                    self.change_level(level_nr = 2)
+                    self.go_to_teleport(teleport = "b")
+                    
+                
+
+            #------ between rocket and enemy ------
+            self.profiler.mark("collide rocket/enemy")
+            for e, r in self.spatialhash.pairs(self.enemygroup, self.rocketgroup):
+                if not r.alive():
+                    continue # already hit another enemy
+                if r.bossnumber == 0 or r.bossnumber == 1:
+                    e.hitpoints -= r.damage
+                    b1 = r.angle -45 + 180
+                    b2 = r.angle + 45 + 180
+                    if self.playtime > self.enemydamagesoundtime:
+                        Viewer.sounds["enemydamage"].play()
+                        self.enemydamagesoundtime = self.playtime + 0.25
+                    Explosion(r.pos, a1=b1, a2=b2, max_age=0.3, red=200, dred=50, minsparks=1, maxsparks=2)
+                r.kill()
+            
+            #------ between guardian and tile ----
+            #for g in self.guardiangroup:
+            #    crashgroup = pygame.sprite.spritecollide(g, self.tilegroup,
+            #                 False, pygame.sprite.collide_rect)
+            #    for t in crashgroup:
+            #        print("crashing", g, t)
+            #        g.pos += -g.move
+            #        g.rect.center = (g.pos.x, -g.pos.y)
+            #        g.move *= -1
+
+    def snapshot(self):
+        """remembers where the camera and every moving sprite are,
+           draw_world draws between this and the next step"""
+        self.previous = ((Viewer.camera.x, Viewer.camera.y),
+                         {s.number: s.rect.center for s in self.allgroup.sprites()
+                          if not s.screen_space and not s.static})
+
+    def draw_world(self, alpha):
+        """draws terrain, sprites and particles alpha (0...1) of the
+           way from the last snapshot to the current step"""
+        camera = Viewer.camera
+        (oldx, oldy), centers = self.previous
+        x, y = camera.x, camera.y
+        camera.x = round(oldx + (x - oldx) * alpha)
+        camera.y = round(oldy + (y - oldy) * alpha)
+        if Game.dirty_rects:
+            self.dirtyscreen.clear(self.background,
+                                   self.terrain if Game.terrain_layer else None, camera)
+            self.dirtyscreen.add(camera.draw(self.screen, self.allgroup, centers, alpha, doreturn=True))
+            rect = self.particles.draw(self.screen, camera)
+            if rect is not None:
+                self.dirtyscreen.add([rect])
+        else:
+            self.screen.blit(self.background, (0, 0))
+            if Game.terrain_layer:
+                self.terrain.draw(self.screen, camera)
+            camera.draw(self.screen, self.allgroup, centers, alpha)
+            self.particles.draw(self.screen, camera)
+        camera.x, camera.y = x, y
+
+    def run(self, frames=None):
+        """The mainloop. If frames is given, the menu is skipped and
+           exactly that many frames are played as fast as possible,
+           each simulating 1/fps seconds"""
         running = True
         pygame.mouse.set_visible(False)
         oldleft, oldmiddle, oldright  = False, False, False
@@ -1487,21 +3296,6 @@ class Viewer():
         self.rotdelta = 5
         self.next_song() # play next song
         NumberSprite(pos = pygame.math.Vector2(100,-100))
-        # ------ joysticks ----
-        pygame.joystick.init()
-        self.joysticks = [pygame.joystick.Joystick(x) for x in range(pygame.joystick.get_count())]
-        for j in self.joysticks:
-            j.init()
-        jpushed = { 0 : {0:False, 1:False, 2:False, 3:False} ,
-                    1 : {0:False, 1:False, 2:False, 3:False}, 
-                    2 : {0:False, 1:False, 2:False, 3:False},
-                    3 : {0:False, 1:False, 2:False, 3:False}
-                   }
-        joldpushed = { 0 : {0:False, 1:False, 2:False, 3:False} ,
-                    1 : {0:False, 1:False, 2:False, 3:False}, 
-                    2 : {0:False, 1:False, 2:False, 3:False},
-                    3 : {0:False, 1:False, 2:False, 3:False}
-                   }
         #self.menutime = False
         #self.menudeltatime = 0
         self.firesoundtime = 0
@@ -1509,10 +3303,44 @@ class Viewer():
         self.playerdamagesoundtime = 0
         self.playerhealingsoundtime = 0
         self.enemydamagesoundtime = 0
-        self.menurun()
+        if frames is None and self.record is None and self.replay is None:
+            self.menurun()
+        timed = frames is not None or self.replay is not None
+        frame = 0
+        starttime = pygame.time.get_ticks()
+        self.accumulator = 0.0 # simulation time not yet stepped
+        self.stepnumber = 0
+        self.snapshot()
+        self.frametimes = [] # milliseconds, only recorded if frames is given or in a replay
+        frametime = time.perf_counter()
         while running:
-            pygame.display.set_caption("fuel: {}".format(self.player1.fuel))
-            milliseconds = self.clock.tick(self.fps) #
+            if timed:
+                if frame > 0:
+                    now = time.perf_counter()
+                    self.frametimes.append((now - frametime) * 1000)
+                    frametime = now
+                if frames is not None and frame >= frames:
+                    break
+            if self.replay is not None:
+                inputframe = self.replay.read_frame()
+                if inputframe is None:
+                    break # end of the log, before counting a frame
+            frame += 1
+            self.profiler.begin_frame("tick")
+            pygame.display.set_caption("fuel: {:.0f}".format(self.player1.fuel))
+            if self.replay is not None:
+                # as fast as possible, with the recorded frame time and quality
+                self.clock.tick()
+                milliseconds = inputframe.milliseconds
+                Viewer.governor.level = inputframe.level
+            elif frames is None:
+                milliseconds = self.clock.tick(self.fps) #
+            else:
+                # uncapped: tick only to measure fps
+                self.clock.tick()
+                milliseconds = 1000 / self.fps
+            if self.replay is None:
+                Viewer.governor.frame(self.clock.get_rawtime()) # without waiting in tick
             #if self.menutime:
             #    self.menudeltatime += milliseconds / 1000
             #    self.menutime = False
@@ -1520,7 +3348,6 @@ class Viewer():
             #self.menudeltatime = 0
             #else:
             #    seconds = milliseconds / 1000
-            self.playtime += seconds
             
             if gameOver:
                 if self.playtime > exittime:
@@ -1528,365 +3355,108 @@ class Viewer():
             #Game over?
             #if not gameOver:
             # -------- events ------
+            self.profiler.mark("events")
+            keydowns = []
             for event in pygame.event.get():
                 if event.type == pygame.QUIT:
                     running = False
-                # ------- pressed and released key ------
+                elif self.replay is not None:
+                    continue # the input comes from the log
+                elif event.type in JoystickInput.events:
+                    self.joystickinput.handle(event, self.stepnumber)
                 elif event.type == pygame.KEYDOWN:
-                    if event.key == pygame.K_1:
-                        self.change_level(0)
-                        #self.lines = self.levels[0]
-                        #self.paint_level() # painted current self.lines 
-                    if event.key == pygame.K_2:
-                        self.change_level(1)
-                        #self.lines = self.levels[1]
-                        #self.paint_level() # painted current self.lines 
-                    if event.key == pygame.K_3:
-                        self.change_level(2)
-                        #self.lines = self.levels[2]
-                        #self.paint_level() # painted current self.lines 
-                    if event.key == pygame.K_p:
-                        if not Game.peace:
-                            Game.peace = True
-                        else:
-                            Game.peace = False
-                    if event.key == pygame.K_i:
-                        self.next_song()
-                    if event.key == pygame.K_o:
-                        Viewer.sounds["hitground"].play()
-                    if event.key == pygame.K_n:
-                        self.generate_level()
-                    if event.key == pygame.K_ESCAPE:
+                    keydowns.append(event.key)
+            # ---- input of this frame, live or replayed ----
+            if self.replay is not None:
+                for device, state in inputframe.joystick:
+                    self.joystickinput.set_state(device, state, self.stepnumber)
+                self.joystickinput.take_recording()
+            else:
+                joystick = [(device, state) for step, device, state
+                            in self.joystickinput.take_recording()]
+                inputframe = InputFrame.live(milliseconds, Viewer.governor.level, keydowns, joystick)
+                if self.record is not None:
+                    self.record.write_frame(inputframe)
+            Viewer.input = inputframe
+            # ------- pressed keys ------
+            for key in inputframe.keydowns:
+                if key == pygame.K_F3:
+                    self.profiler.toggle()
+                if key == pygame.K_F4:
+                    self.profiler.export("trace.json")
+                if key == pygame.K_1:
+                    self.change_level(0)
+                    #self.lines = self.levels[0]
+                    #self.paint_level() # painted current self.lines 
+                if key == pygame.K_2:
+                    self.change_level(1)
+                    #self.lines = self.levels[1]
+                    #self.paint_level() # painted current self.lines 
+                if key == pygame.K_3:
+                    self.change_level(2)
+                    #self.lines = self.levels[2]
+                    #self.paint_level() # painted current self.lines 
+                if key == pygame.K_p:
+                    if not Game.peace:
+                        Game.peace = True
+                    else:
+                        Game.peace = False
+                if key == pygame.K_i:
+                    self.next_song()
+                if key == pygame.K_o:
+                    Viewer.sounds["hitground"].play()
+                if key == pygame.K_n:
+                    self.seeds[self.active_level] = random.getrandbits(32)
+                    self.generate_level(cache=False) # a seed never seen again
+                if key == pygame.K_ESCAPE:
+                    running = False
+                if key == pygame.K_TAB:
+                    self.player1.fire(self.cannon1.angle)
+                if key == pygame.K_m and self.record is None and self.replay is None:
+                    #self.menutime = True
+                    result = self.menurun()
+                    self.dirtyscreen.invalidate()
+                    self.joystickinput.release_all(self.stepnumber)
+                    if result == -1:
                         running = False
-                    if event.key == pygame.K_TAB:
-                        self.player1.fire(self.cannon1.angle)
-                    if event.key == pygame.K_m:
-                        #self.menutime = True
-                        result = self.menurun()
-                        if result == -1:
-                            running = False
-                    # ---- -simple movement for self.player1 -------
-                    if event.key == pygame.K_RIGHT:
-                        self.player1.move += pygame.math.Vector2(10,0)
-                    if event.key == pygame.K_LEFT:
-                        self.player1.move += pygame.math.Vector2(-10,0)
-                    if event.key == pygame.K_UP:
-                        self.player1.move += pygame.math.Vector2(0,10)
-                    if event.key == pygame.K_DOWN:
-                        self.player1.move += pygame.math.Vector2(0,-10)
-                    # ---- stop movement for self.player1 -----
-                    if event.key == pygame.K_r:
-                        self.player1.move *= 0.1 # remove 90% of movement
-                    if event.key == pygame.K_b:
-                        Game.playerspeed = 1
-                        self.player1.move = pygame.math.Vector2(0,0)
+                # ---- -simple movement for self.player1 -------
+                if key == pygame.K_RIGHT:
+                    self.player1.move += pygame.math.Vector2(10,0)
+                if key == pygame.K_LEFT:
+                    self.player1.move += pygame.math.Vector2(-10,0)
+                if key == pygame.K_UP:
+                    self.player1.move += pygame.math.Vector2(0,10)
+                if key == pygame.K_DOWN:
+                    self.player1.move += pygame.math.Vector2(0,-10)
+                # ---- stop movement for self.player1 -----
+                if key == pygame.K_r:
+                    self.player1.move *= 0.1 # remove 90% of movement
+                if key == pygame.K_b:
+                    Game.playerspeed = 1
+                    self.player1.move = pygame.math.Vector2(0,0)
+            if self.script is not None:
+                self.script(self, frame)
+            Viewer.governor.limit("text", self.flytextgroup, Game.max_flytexts)
                     
    
-            # delete everything on screen
-            self.screen.blit(self.background, (0, 0))
-            
-            # ------ move indicator for self.player1 -----
-            
-            
-            # --- line from eck to mouse ---
-            
-            # ------------ pressed keys ------
-            pressed_keys = pygame.key.get_pressed()
-            
-
-            # if pressed_keys[pygame.K_LSHIFT]:
-                # paint range circles for cannons
-            # ---------- player 2 ------------------
-            if pressed_keys[pygame.K_a]:
-                self.player2.rotate(3)
-            if pressed_keys[pygame.K_d]:
-                self.player2.rotate(-3)
-            if pressed_keys[pygame.K_w]:
-                if self.player2.fuel > 0:
-                    self.player2.move_forward()
-                    self.player2.fuel -= 1
-            if pressed_keys[pygame.K_s]:
-                if self.player2.fuel > 0:
-                    self.player2.move_backward()
-                    self.player2.fuel -= 1
-            if pressed_keys[pygame.K_LSHIFT]:
-                self.player2.fire(self.cannon2.angle)
-    
-            
-    
-            # ------ mouse handler ------
-            left,middle,right = pygame.mouse.get_pressed()
-            
-            #if right:
-            #    self.player1.move_forward()
-            #if left:
-            #    self.player1.fire(self.cannon1.angle)
-            #if middle:
-            #    self.cannon1.mouseaim = True
-            #else:
-            #    self.cannon1.mouseaim = False
-            #    # rotate player1 toward mouse
-            #    mv = pygame.math.Vector2(pygame.mouse.get_pos()[0], -pygame.mouse.get_pos()[1])
-            #    diff = mv - self.player1.pos 
-            #    self.player1.angle = -diff.angle_to(pygame.math.Vector2(1,0))
-            oldleft, oldmiddle, oldright = left, middle, right
-
-          
-            
-            #--------------------
-            # ------ joystick handler -------
-            #mouses = [self.mouse4, self.mouse5]
-            for number, j in enumerate(self.joysticks):
-                # ====== number is di nummer des joysticks, oida! ====
-                if number == 0 or number==1:  #  or number==2 or number==3:
-                    #x = j.get_axis(0)
-                    #y = j.get_axis(1)
-                    #mouses[number].x += x * 20 # *2 
-                    #mouses[number].y += y * 20 # *2 
-                    buttons = j.get_numbuttons()
-                    hats = j.get_numhats()
-                    axes = j.get_numaxes()
-                    for b in range(buttons):
-                        #if b > 3:
-                        #    continue   # uns interessieren nur die ersten 4 buttons
-                        # ========= b is di interne nummer vom joystickbutton , kapiert? ============ print("was ist b?", b)
-                        
-                        
-                        pushed = j.get_button( b )
-                        #print(j, pushed)
-                        # === pushed is demnach true oda foisch, gö?
-                        #jpushed[number][b] = False # prinzipiell amal auf falsch setzen
-                        jpushed[number][b] = pushed
-                        
-                        if b==0 and pushed :
-                            if number == 0:
-                                if self.playtime > self.firesoundtime:
-                                     Viewer.sounds["playershooting"].play()
-                                     self.firesoundtime = self.playtime + 0.36
-                                self.player1.fire(self.cannon1.angle)
-                            elif number == 1:
-                                if self.playtime > self.firesoundtime:
-                                     Viewer.sounds["playershooting"].play()
-                                     self.firesoundtime = self.playtime + 0.36
-                                self.player2.fire(self.cannon2.angle)
-                        if b==6: #and pushed:
-                            
-                            # linke schultertaste
-                            if number == 0:
-                                if pushed:
-                                    self.cannon1.delta_angle += 5
-                                #else:
-                                #    self.cannon1.delta_angle = 0
-                            if number == 1:
-                                if pushed:
-                                    self.cannon2.delta_angle += 5
-                                #else:
-                                #    self.cannon2.delta_angle = 0
-                            #Flytext(100,100, "button1")
-                        if b==7: #and pushed:
-                            if number == 0:
-                                if pushed:
-                                    self.cannon1.delta_angle -= 5
-                                #else:
-                                #    self.cannon1.delta_angle = 0
-                            if number == 1:
-                                if pushed:
-                                    self.cannon2.delta_angle -= 5
-                                #else:
-                                #    self.cannon2.delta_angle = 0
-                            # rechte Schultertaste
-                        joldpushed[number][b] = jpushed[number][b]
-                    #for a in range(axes):
-                    #    axis = j.get_axis(a) 
-                    #    print(j, axis)     
-                    for h in range(hats):
-                        if h != 0:
-                            continue 
-                        hat = j.get_hat(h)
-                        #print(j, h, str(hat), hat)
-                        for pnr, p in enumerate((self.player1, self.player2)):
-                            if number == pnr:
-                                if hat[1] == 1:
-                                    p.move_forward()
-                                    p.fuel -= 1
-                                if hat[1] == -1:
-                                    p.move_backward()
-                                    p.fuel -= 1
-                                if hat[0] == -1:
-                                    p.rotate(3)
-                                if hat[0] == 1:
-                                    p.rotate(-3)
-                                    
-                            
-                            #if number == 0:
-                            #    self.player1.move_forward()
-                            #    self.player1.fuel -= 1
-                            #elif number == 1:
-                            #    self.player2.move_forward()
-                            #    self.player2.fuel -= 1
-
-                                
-            self.allgroup.update(seconds)
-
-
+            # ---- simulation in fixed steps of 1/Game.sim_rate seconds ----
+            dt = 1 / Game.sim_rate
+            self.accumulator += seconds
+            steps = min(int(self.accumulator / dt), Game.max_steps)
+            for n in range(steps):
+                if n == steps - 1:
+                    self.snapshot() # draw between the last two steps
+                self.step(dt)
+            if steps == Game.max_steps:
+                self.accumulator = 0 # too slow: slow motion instead of catching up
+            else:
+                self.accumulator -= steps * dt
             
-            # ======== collision detections ============
-            if 0 in VectorSprite.numbers:
-                #----- between Tile and player ------
-                for p in self.playergroup:
-                    crashgroup = pygame.sprite.spritecollide(p, self.tilegroup,
-                                 False, pygame.sprite.collide_rect)
-                    for t in crashgroup:
-                         # elastic_collision(p, m)
-                         t.hitpoints -= 1
-                         if t.tile_status == 2:
-                             #healing tile
-                            p.hitpoints += 1
-                            if self.playtime > self.playerhealingsoundtime:
-                                Viewer.sounds["playerhealing"].play()
-                                self.playerhealingsoundtime = self.playtime + 0.40
-                                
-                         else:
-                             p.hitpoints -= 1
-                             if self.playtime > self.groundhitsoundtime:
-                                Viewer.sounds["hitground"].play()
-                                self.groundhitsoundtime = self.playtime + 0.43
-                             Explosion(t.pos, red=200, dred=50, minsparks=1, maxsparks=2)
-                         
-                         
-                         # teleport player away from tile
-                         diff = p.pos - t.pos
-                         diff.normalize_ip()
-                         p.pos += diff * 6
-                         
-                         #elastic_collision(t,p)                    
-                         #v = p.move * -1
-                         #ok = True
-                         #try: 
-                         #   v.normalize_ip()
-                         #except:
-                         #    ok = False
-                         #if ok:
-                         #   v *= 4 # distance to wall
-                         #   p.pos += v
-                         #   #p.pos += (p.move * -1)
-                         #p.pos = pygame.math.Vector2(p.oldpos.x, p.oldpos.y)
-                         p.move = pygame.math.Vector2(0,0)
-                         p.rect.center = ( round(p.pos.x, 0), -round(p.pos.y, 0) )
-                         self.cannon1.update(0)
-                         #self.cannon1.pos = pygame.math.Vector2(p.pos.x, p.pos.y)
-                         #self.cannon1.center = p.rect.center
-                        
-                
-                
-                #------ between Tile and rocket ------
-                for r in self.rocketgroup:
-                    crashgroup = pygame.sprite.spritecollide(r, self.tilegroup,
-                                False, pygame.sprite.collide_rect)
-                    for t in crashgroup:
-                        #print("r.bossnr, t.tilest", r.bossnumber, t.tile_status)
-                        if r.bossnumber == 0 or r.bossnumber == 1:
-                            if t.tile_status == 0:
-                                #print("hitting normal tile")
-                                # normal
-                                b1 = r.angle -45 + 180
-                                b2 = r.angle + 45 + 180
-                                if self.playtime > self.groundhitsoundtime:
-                                    Viewer.sounds["hitground"].play()
-                                    self.groundhitsoundtime = self.playtime + 0.43
-                                Explosion(r.pos, a1=b1, a2=b2, max_age=0.3, red=0, green=0, blue=0, dred=0, dgreen = 0, dblue = 0, minsparks=1, maxsparks=10)
-                                t.hitpoints -= r.damage
-                            elif t.tile_status == 1:
-                                # golden
-                                b1 = r.angle -45 + 180
-                                b2 = r.angle + 45 + 180
-                                if self.playtime > self.groundhitsoundtime:
-                                    Viewer.sounds["hitground"].play()
-                                    self.groundhitsoundtime = self.playtime + 0.43
-                                Explosion(r.pos, a1=b1, a2=b2, max_age=0.3, red=255, green=165, blue=0, dred=15, dgreen = 15, dblue = 15, minsparks=1, maxsparks=10)
-                                t.hitpoints -= r.damage
-                                if t.hitpoints <= 0:
-                                    Game.gold += 1
-                            else:
-                                # healing
-                                if self.playtime > self.playerhealingsoundtime:
-                                    Viewer.sounds["playerhealing"].play()
-                                    self.playerhealingsoundtime = self.playtime + 0.40
-                                VectorSprite.numbers[r.bossnumber].hitpoints += r.damage    
-                                b1 = r.angle -45 + 180
-                                b2 = r.angle + 45 + 180
-                                Explosion(r.pos, a1=b1, a2=b2, max_age=0.3, red=0, green=255, blue=0, dred=15, dgreen = 15, dblue = 15, minsparks=1, maxsparks=10)
-                                t.hitpoints -= r.damage
-                        r.kill()
-                
-                #------ between player and rocket ------
-                for p in self.playergroup:
-                    crashgroup = pygame.sprite.spritecollide(p, self.rocketgroup,
-                                 False, pygame.sprite.collide_rect)
-                    for r in crashgroup:
-                        if r.bossnumber != 0 and r.bossnumber != 1:
-                            p.hitpoints -= r.damage
-                            b1 = r.angle -45 + 180
-                            b2 = r.angle + 45 + 180
-                            if self.playtime > self.playerdamagesoundtime:
-                                Viewer.sounds["playerdamage"].play()
-                                self.playerdamagesoundtime = self.playtime + 0.55
-                            Explosion(r.pos, a1=b1, a2=b2, max_age=0.3, red=200, dred=50, minsparks=1, maxsparks=2)
-                            r.kill()
-                
-                #------ between player and Refuel --------
-                for p in self.playergroup:
-                    crashgroup = pygame.sprite.spritecollide(p,self.fuelgroup,
-                                 False, pygame.sprite.collide_rect)
-                    for f in crashgroup:
-                        p.fuel += 10
-                        
-                
-                #------ between player and NumberSprite ------
-                for p in self.playergroup:
-                    crashgroup = pygame.sprite.spritecollide(p,self.numbergroup,
-                                 False, pygame.sprite.collide_rect)
-                    for n in crashgroup:
-                        
-                        if n.msg == "A":
-                            # teleport to level 1
-                            self.change_level(level_nr = 1)
-                            self.go_to_teleport(teleport = "a")
-                        elif n.msg == "B":
-                            # teleport to level 2
-                            self.change_level(level_nr = 2)
-                            self.go_to_teleport(teleport = "b")
-                        
-                    
-
-                #------ between rocket and enemy ------
-                for e in self.enemygroup:
-                    crashgroup = pygame.sprite.spritecollide(e, self.rocketgroup,
-                                 False, pygame.sprite.collide_rect)
-                    for r in crashgroup:
-                        if r.bossnumber == 0 or r.bossnumber == 1:
-                            e.hitpoints -= r.damage
-                            b1 = r.angle -45 + 180
-                            b2 = r.angle + 45 + 180
-                            if self.playtime > self.enemydamagesoundtime:
-                                Viewer.sounds["enemydamage"].play()
-                                self.enemydamagesoundtime = self.playtime + 0.25
-                            Explosion(r.pos, a1=b1, a2=b2, max_age=0.3, red=200, dred=50, minsparks=1, maxsparks=2)
-                        r.kill()
-                
-                #------ between guardian and tile ----
-                #for g in self.guardiangroup:
-                #    crashgroup = pygame.sprite.spritecollide(g, self.tilegroup,
-                #                 False, pygame.sprite.collide_rect)
-                #    for t in crashgroup:
-                #        print("crashing", g, t)
-                #        g.pos += -g.move
-                #        g.rect.center = (g.pos.x, -g.pos.y)
-                #        g.move *= -1
-                
             # ----------- clear, draw , update, flip -----------------
-            self.allgroup.draw(self.screen)
+            self.profiler.mark("draw")
+            self.draw_world(self.accumulator / dt)
             
+            self.profiler.mark("hud")
             hppercent = self.player1.hitpoints / Game.playerhitpoints
             g = max(0, 255 * hppercent)
             g = min(255 * hppercent, 255)
@@ -1926,22 +3496,95 @@ class Viewer():
             write(self.screen, "fuel: {}".format(self.player2.fuel), x=self.width // 2 + 10, y=Viewer.height-16, fontsize = 14, color = (255,255,255))
             write(self.screen, "FPS: {:8.3}  rockets: {} gold: {}".format(self.clock.get_fps(),
             Game.rockets, Game.gold), x=1150, y=0, fontsize = 14, color = (255,255,255))
+            write(self.screen, Viewer.governor.text(), x=self.width - 440, y=18, fontsize = 14, color = (255,255,255))
+            if Game.dirty_rects: # hitpoints and fuel bars, texts
+                self.dirtyscreen.add([pygame.Rect(0, 0, self.width, 36),
+                                      pygame.Rect(0, Viewer.height-16, self.width, 16)])
             
             # --- Martins verbesserter Mousetail -----
+            self.profiler.mark("mousetail")
+            length = Viewer.governor.scale("tail", Mouse.tail_length) # once per frame
             for mouse in self.mousegroup:
-                if len(mouse.tail)>2:
-                    for a in range(1,len(mouse.tail)):
+                tail = mouse.tail[:length]
+                if len(tail)>2:
+                    for a in range(1,len(tail)):
                         r,g,b = mouse.color
-                        pygame.draw.line(self.screen,(r-a,g,b),
-                                     mouse.tail[a-1],
-                                     mouse.tail[a],10-a*10//10)
+                        rect = pygame.draw.line(self.screen,(r-a,g,b),
+                                     tail[a-1],
+                                     tail[a],10-a*10//10)
+                        if Game.dirty_rects and rect.width:
+                            self.dirtyscreen.add([rect])
             
+            self.profiler.mark("overlay")
+            rect = self.profiler.draw(self.screen)
             # -------- next frame -------------
-            pygame.display.flip()
+            self.profiler.mark("flip")
+            if Game.dirty_rects:
+                if rect is not None:
+                    self.dirtyscreen.add([rect])
+                self.dirtyscreen.present()
+            else:
+                pygame.display.flip()
+            self.profiler.end_frame()
         #-----------------------------------------------------
+        if timed:
+            duration = (pygame.time.get_ticks() - starttime) / 1000
+            print("{} frames in {:.2f} seconds ({:.1f} fps)".format(
+                  frame, duration, frame / max(duration, 0.001)))
+        for pool in VectorSprite.pools.values():
+            print(pool)
+        if Game.dirty_rects and frame > 0:
+            print(self.dirtyscreen)
+        if self.tracefile is not None:
+            self.profiler.export(self.tracefile)
+        for log in (self.record, self.replay):
+            if log is not None:
+                log.close()
+                print("{} frames {}".format(log.frames, "recorded" if log is self.record else "replayed"))
+        self.worker.shutdown(wait=False, cancel_futures=True)
         pygame.mouse.set_visible(True)    
         pygame.quit()
 
 if __name__ == '__main__':
-    Viewer(1430,800).run() # try Viewer(800,600).run()
+    parser = argparse.ArgumentParser(description="cave system")
+    parser.add_argument("--headless", action="store_true",
+                        help="no window and no sound (SDL dummy drivers)")
+    parser.add_argument("--frames", type=int, default=None,
+                        help="skip the menu and play this many frames as fast as possible")
+    parser.add_argument("--seed", type=int, default=None,
+                        help="levels are made from seeds SEED, SEED+1, SEED+2")
+    parser.add_argument("--trace", default=None,
+                        help="write a chrome trace of the frame phases to this file at the end")
+    parser.add_argument("--world", default=None,
+                        help="world size in window sizes, like 4x3 (default 1x1)")
+    parser.add_argument("--fps", type=int, default=30,
+                        help="frames drawn per second (default 30)")
+    parser.add_argument("--sim-rate", type=int, default=Game.sim_rate,
+                        help="simulation steps per second (default {})".format(Game.sim_rate))
+    parser.add_argument("--no-governor", action="store_true",
+                        help="always full quality, even when frames take too long")
+    parser.add_argument("--record", default=None,
+                        help="record the seed, input and frame times of this session to a file")
+    parser.add_argument("--replay", default=None,
+                        help="replay a recorded session headless and as fast as possible")
+    args = parser.parse_args()
+    if args.no_governor:
+        Game.load_governor = False
+    if args.seed is not None:
+        Game.level_seeds = [args.seed + i for i in range(3)]
+    if args.world is not None:
+        Game.world_screens = tuple(int(n) for n in args.world.split("x"))
+    Game.sim_rate = args.sim_rate
+    if args.replay is not None:
+        replay = SessionLog.open(args.replay) # the recorded settings
+        viewer = Viewer(replay.width, replay.height, fps=replay.fps, headless=True)
+        viewer.replay = replay
+    else:
+        if args.record is not None:
+            Game.random_seed = random.getrandbits(63)
+        viewer = Viewer(1430,800, fps=args.fps, headless=args.headless)
+        if args.record is not None:
+            viewer.record = SessionLog.create(args.record, viewer.width, viewer.height, viewer.fps)
+    viewer.tracefile = args.trace
+    viewer.run(frames=args.frames) # try Viewer(800,600).run()
 